@@ -0,0 +1,277 @@
+"""Benchmark d4utils sum and count scaling.
+
+Generate synthetic d4 files over a grid of sample counts, genome sizes,
+coverage distributions and sparsity, run `d4utils sum` and `d4utils
+count` over a grid of cores and chunk sizes, and write wall time, peak
+RSS, throughput and parallel efficiency to a JSON report that can be
+diffed between versions.
+
+Example:
+
+    python benchmarks/benchmark.py -o report.json --samples 10,100 \\
+        --genome-size 1000000 --cores 1,4 --chunk-size 100000,1000000
+
+"""
+
+import importlib.metadata
+import json
+import logging
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from itertools import product
+from typing import Any
+
+import click
+import numpy as np
+import pyd4
+
+logger = logging.getLogger(__name__)
+
+DISTRIBUTIONS = ("poisson", "uniform", "constant")
+
+
+def int_list(
+    ctx: click.core.Context, param: click.core.Option, value: str
+) -> list[int]:  # pylint: disable=unused-argument
+    """Parse comma-separated integer list."""
+    return [int(float(x)) for x in value.split(",")]
+
+
+def float_list(
+    ctx: click.core.Context, param: click.core.Option, value: str
+) -> list[float]:  # pylint: disable=unused-argument
+    """Parse comma-separated float list."""
+    return [float(x) for x in value.split(",")]
+
+
+def simulate_coverage(
+    rng: np.random.Generator,
+    size: int,
+    distribution: str,
+    mean: float,
+    sparsity: float,
+) -> np.ndarray:
+    """Simulate a coverage track.
+
+    Coverage is drawn in runs of random length so that tracks have the
+    run structure of real data. A fraction `sparsity` of the runs is
+    set to zero.
+    """
+    nruns = max(1, size // 100)
+    lengths = rng.geometric(1 / 100, nruns)
+    if distribution == "poisson":
+        values = rng.poisson(mean, nruns)
+    elif distribution == "uniform":
+        values = rng.integers(0, int(2 * mean) + 1, nruns)
+    else:
+        values = np.full(nruns, int(mean))
+    values[rng.random(nruns) < sparsity] = 0
+    track = np.repeat(values, lengths)
+    if track.shape[0] < size:
+        track = np.pad(track, (0, size - track.shape[0]))
+    return track[:size].astype(np.int32)
+
+
+def make_dataset(
+    outdir: pathlib.Path,
+    nsamples: int,
+    genome_size: int,
+    distribution: str,
+    sparsity: float,
+    mean: float,
+    seed: int,
+) -> list[pathlib.Path]:
+    """Write synthetic single-chromosome d4 files and return paths."""
+    outdir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(nsamples):
+        fn = outdir / f"s{i}.d4"
+        if not fn.exists():
+            coverage = simulate_coverage(
+                rng, genome_size, distribution, mean, sparsity
+            )
+            writer = (
+                pyd4.D4Builder(str(fn))
+                .add_chroms([("chr1", genome_size)])
+                .get_writer()
+            )
+            writer.write_np_array("chr1", 0, coverage)
+            writer.close()
+        paths.append(fn)
+    return paths
+
+
+def run_command(args: list[str]) -> tuple[float, int, int]:
+    """Run command and return wall time, peak RSS (kB) and exit code.
+
+    Peak RSS is the largest resident set size of any process in the
+    command's process tree, as reported by wait4.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            stderr.seek(0)
+            logger.error(stderr.read().decode())
+    return wall, rusage.ru_maxrss, proc.returncode
+
+
+def add_efficiency(records: list[dict[str, Any]]) -> None:
+    """Add parallel efficiency relative to the single-core run."""
+
+    def key(r: dict[str, Any]) -> tuple[Any, ...]:
+        return tuple(v for k, v in r["params"].items() if k != "cores")
+
+    baseline = {
+        key(r): r["wall_time"]
+        for r in records
+        if r["params"]["cores"] == 1 and r["exit_code"] == 0
+    }
+    for r in records:
+        t1 = baseline.get(key(r))
+        if t1 is None or r["exit_code"] != 0:
+            r["speedup"] = None
+            r["parallel_efficiency"] = None
+            continue
+        r["speedup"] = t1 / r["wall_time"]
+        r["parallel_efficiency"] = r["speedup"] / r["params"]["cores"]
+
+
+def metadata() -> dict[str, Any]:
+    """Return report metadata."""
+    try:
+        version = importlib.metadata.version("d4utils")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    return {
+        "d4utils_version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "date": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+@click.command(help=__doc__)
+@click.option(
+    "--output", "-o", help="JSON report", type=click.Path(), required=True
+)
+@click.option("--workdir", help="directory for synthetic data", default=None)
+@click.option(
+    "--command",
+    "commands",
+    help="commands to benchmark",
+    type=click.Choice(["sum", "count"]),
+    multiple=True,
+    default=["sum", "count"],
+)
+@click.option("--samples", default="10", callback=int_list)
+@click.option("--genome-size", default="1000000", callback=int_list)
+@click.option(
+    "--distribution",
+    "distributions",
+    type=click.Choice(DISTRIBUTIONS),
+    multiple=True,
+    default=["poisson"],
+)
+@click.option("--sparsity", default="0.0", callback=float_list)
+@click.option("--cores", default="1", callback=int_list)
+@click.option("--chunk-size", default="1000000", callback=int_list)
+@click.option("--mean-coverage", default=10.0, type=float)
+@click.option("--repeat", default=1, type=int, help="runs per setting")
+@click.option(
+    "--extra-args",
+    default="",
+    help="extra arguments passed to every d4utils call",
+)
+@click.option("--seed", default=42, type=int)
+def main(
+    output: str,
+    workdir: str,
+    commands: list[str],
+    samples: list[int],
+    genome_size: list[int],
+    distributions: list[str],
+    sparsity: list[float],
+    cores: list[int],
+    chunk_size: list[int],
+    mean_coverage: float,
+    repeat: int,
+    extra_args: str,
+    seed: int,
+) -> None:
+    """Run benchmark grid."""
+    logging.basicConfig(level=logging.INFO)
+    tmp = tempfile.TemporaryDirectory() if workdir is None else None
+    root = pathlib.Path(workdir if tmp is None else tmp.name)
+    records = []
+    data_grid = product(samples, genome_size, distributions, sparsity)
+    for nsamples, size, distribution, sp in data_grid:
+        datadir = root / (
+            f"n{nsamples}_g{size}_{distribution}_s{sp}"
+            f"_c{mean_coverage}_r{seed}"
+        )
+        logger.info("Generating %s", datadir)
+        paths = make_dataset(
+            datadir, nsamples, size, distribution, sp, mean_coverage, seed
+        )
+        run_grid = product(commands, cores, chunk_size)
+        for command, ncores, csize in run_grid:
+            params = {
+                "command": command,
+                "samples": nsamples,
+                "genome_size": size,
+                "distribution": distribution,
+                "sparsity": sp,
+                "chunk_size": csize,
+                "cores": ncores,
+            }
+            times, rss = [], []
+            exit_code = 0
+            for i in range(repeat):
+                out = datadir / f"{command}_{ncores}_{csize}_{i}.d4"
+                args = [sys.executable, "-m", "d4utils", command]
+                args += [str(x) for x in paths] + [str(out)]
+                args += ["-j", str(ncores), "--chunk-size", str(csize)]
+                args += extra_args.split()
+                if command == "count":
+                    args += ["--min-coverage", "1"]
+                wall, maxrss, exit_code = run_command(args)
+                out.unlink(missing_ok=True)
+                if exit_code != 0:
+                    break
+                times.append(wall)
+                rss.append(maxrss)
+            record: dict[str, Any] = {"params": params, "exit_code": exit_code}
+            if exit_code == 0:
+                wall = statistics.median(times)
+                record.update(
+                    {
+                        "wall_time": wall,
+                        "wall_times": times,
+                        "peak_rss_kb": max(rss),
+                        "throughput": size * nsamples / wall,
+                    }
+                )
+            logger.info("%s", record)
+            records.append(record)
+    add_efficiency(records)
+    with open(output, "w", encoding="utf-8") as fh:
+        json.dump({"metadata": metadata(), "results": records}, fh, indent=2)
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -1,20 +1,80 @@
 """D4Utils command-line interface."""
 
+import importlib
+from typing import Any, Union
+
 import click
 
-from d4utils.count import count
-from d4utils.sum import sum
 
+class LazyGroup(click.Group):
+    """Click group that imports subcommands only when they are invoked.
+
+    Subcommands are given as a mapping from command name to a tuple of
+    import path, in the form `module:attribute`, and short help. The
+    short help is used to list commands, so that `--help` and
+    `--version` do not import the subcommand modules and their heavy
+    dependencies.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        lazy_subcommands: Union[dict[str, tuple[str, str]], None] = None,
+        **kwargs: Any,
+    ):
+        """Initialize group with lazy subcommands."""
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        """List eager and lazy subcommands."""
+        return sorted(super().list_commands(ctx) + list(self.lazy_subcommands))
+
+    def get_command(
+        self, ctx: click.Context, cmd_name: str
+    ) -> Union[click.Command, None]:
+        """Return subcommand, importing it if it is lazy."""
+        if cmd_name in self.lazy_subcommands:
+            import_path, _ = self.lazy_subcommands[cmd_name]
+            modname, attr = import_path.split(":")
+            return getattr(importlib.import_module(modname), attr)
+        return super().get_command(ctx, cmd_name)
 
-@click.group(help=__doc__)
+    def format_commands(
+        self, ctx: click.Context, formatter: click.HelpFormatter
+    ) -> None:
+        """Write commands to help without importing lazy subcommands."""
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.lazy_subcommands:
+                rows.append((name, self.lazy_subcommands[name][1]))
+                continue
+            cmd = self.get_command(ctx, name)
+            if cmd is None or cmd.hidden:
+                continue
+            rows.append((name, cmd.get_short_help_str()))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
+@click.group(
+    help=__doc__,
+    cls=LazyGroup,
+    lazy_subcommands={
+        "count": ("d4utils.count:count", "Count coverages within a range."),
+        "merge": ("d4utils.merge:merge", "Merge shard outputs."),
+        "stats": (
+            "d4utils.stats:stats",
+            "Compute several statistics across d4 tracks in one pass.",
+        ),
+        "sum": ("d4utils.sum:sum", "Sum d4 coverage tracks."),
+    },
+)
 @click.version_option()
 def main() -> None:
     """D4Utils."""
 
 
-main.add_command(sum)
-main.add_command(count)
-
-
 if __name__ == "__main__":
     main(prog_name="d4utils")  # pragma: no cover
@@ -15,8 +15,12 @@ def outfile() -> Callable[[FC], FC]:
     def outfile_callback(
         ctx: click.core.Context, param: click.core.Option, value: pathlib.Path
     ) -> pathlib.Path:  # pylint: disable=unused-argument
-        """Outfile callback."""
-        if pathlib.Path(value).exists():
+        """Outfile callback.
+
+        An existing outfile is allowed when resuming, since it is the
+        partial output of the interrupted job.
+        """
+        if pathlib.Path(value).exists() and not ctx.params.get("resume"):
             logging.error(
                 f"{value} exists! Make sure to provide "
                 "a non-existing output file name"
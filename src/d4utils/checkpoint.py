@@ -0,0 +1,215 @@
+"""Checkpointing of reduced chunks.
+
+A checkpoint is a directory next to the output file that holds a
+manifest and a data file. Every chunk written to the output is also
+staged to the data file as run-length encoded int32 starts and values,
+and a manifest line recording its plan index and location is appended
+once the data has been synced to disk. A restarted job with the same
+configuration reads the manifest, rewrites staged chunks to the new
+output and only recomputes the chunks that are missing.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from d4utils.d4 import D4Container
+from d4utils.runs import from_runs, to_runs
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.jsonl"
+DATA = "chunks.bin"
+
+
+def job_key(
+    d4container: D4Container, statistic: str, *, shard: bool = True
+) -> str:
+    """Return key identifying the configuration of a job.
+
+    The key covers everything that determines the chunk results: the
+    statistic, input paths, chromosomes, regions, coverage range and
+    updated track, and, if `shard` is true, the shard of the job.
+    """
+    config: dict[str, Any] = {
+        "statistic": statistic,
+        "path": [str(x) for x in d4container.path],
+        "chroms": [list(x) for x in d4container.chroms],
+        "regions": [list(x) for x in d4container.regions],
+        "min_coverage": float(d4container.min_coverage),
+        "max_coverage": float(d4container.max_coverage),
+        "update": None
+        if d4container.update is None
+        else str(d4container.update),
+    }
+    if shard:
+        config["shard"] = d4container.shard
+    return hashlib.sha256(json.dumps(config).encode()).hexdigest()
+
+
+def make_checkpoint(
+    d4container: D4Container, statistic: str, checkpoint: bool, resume: bool
+) -> Union["Checkpoint", None]:
+    """Return checkpoint next to the container outfile, if requested.
+
+    With `resume`, the manifest of an existing checkpoint is loaded so
+    that its staged chunks are skipped.
+    """
+    if not (checkpoint or resume):
+        return None
+    ckpt = Checkpoint(
+        f"{d4container.outfile}.checkpoint", job_key(d4container, statistic)
+    )
+    if resume:
+        ckpt.load_manifest()
+    return ckpt
+
+
+class Checkpoint:
+    """Checkpoint directory with a chunk manifest and staged results."""
+
+    def __init__(self, directory: Union[str, Path], key: str):
+        """Create checkpoint handle for directory and job key."""
+        self._directory = Path(directory)
+        self._key = key
+        self._chunk_size: Union[int, None] = None
+        self._done: dict[int, tuple[int, int]] = {}
+        self._loaded = False
+        self._data: Any = None
+        self._manifest: Any = None
+
+    @property
+    def directory(self) -> Path:
+        """Return checkpoint directory."""
+        return self._directory
+
+    @property
+    def chunk_size(self) -> Union[int, None]:
+        """Return chunk size recorded in the checkpoint."""
+        return self._chunk_size
+
+    @property
+    def done(self) -> dict[int, tuple[int, int]]:
+        """Return staged chunks as plan index to (offset, nruns)."""
+        return self._done
+
+    def load_manifest(self) -> None:
+        """Load an existing manifest.
+
+        A trailing incomplete line, left by a job that was killed while
+        appending, is ignored, and a manifest with an incomplete header
+        is treated as no checkpoint. Raises ValueError if the checkpoint
+        was made by a job with a different configuration.
+        """
+        path = self._directory / MANIFEST
+        self._loaded = True
+        if not path.exists():
+            return
+        with open(path, encoding="utf-8") as fh:
+            lines = fh.read().split("\n")
+        try:
+            header = json.loads(lines[0])
+        except json.JSONDecodeError:
+            logger.warning("Ignoring checkpoint with an incomplete header")
+            return
+        if header["key"] != self._key:
+            raise ValueError(
+                f"checkpoint {self._directory} was made by a job with a "
+                "different configuration"
+            )
+        self._chunk_size = header["chunk_size"]
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self._done[entry["chunk"]] = (entry["offset"], entry["nruns"])
+        logger.info(
+            "Resuming from checkpoint with %i staged chunks", len(self._done)
+        )
+
+    def open(self, chunk_size: int) -> None:
+        """Open checkpoint for staging chunks.
+
+        Unless a manifest has been loaded, any existing checkpoint is
+        discarded. Otherwise, data beyond the last complete manifest
+        entry is truncated.
+        """
+        if not self._loaded:
+            self.remove()
+        self._directory.mkdir(parents=True, exist_ok=True)
+        manifest = self._directory / MANIFEST
+        if self._chunk_size is not None and self._chunk_size != chunk_size:
+            raise ValueError(
+                f"checkpoint chunk size {self._chunk_size} differs from "
+                f"job chunk size {chunk_size}"
+            )
+        self._chunk_size = chunk_size
+        end = max(
+            (offset + 8 * nruns for offset, nruns in self._done.values()),
+            default=0,
+        )
+        self._data = open(self._directory / DATA, "ab")
+        self._data.truncate(end)
+        self._data.seek(end)
+        if self._done:
+            self._manifest = open(manifest, "a", encoding="utf-8")
+            # Terminate a possibly incomplete trailing line
+            self._manifest.write("\n")
+        else:
+            self._manifest = open(manifest, "w", encoding="utf-8")
+            header = {"key": self._key, "chunk_size": chunk_size}
+            self._manifest.write(json.dumps(header) + "\n")
+        self._sync(self._manifest)
+
+    @staticmethod
+    def _sync(fh: Any) -> None:
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    def stage(self, index: int, data: npt.NDArray[np.int32]) -> None:
+        """Stage reduced chunk with plan index `index`."""
+        starts, values = to_runs(data)
+        offset = self._data.tell()
+        self._data.write(starts.astype(np.int32).tobytes())
+        self._data.write(values.astype(np.int32).tobytes())
+        self._sync(self._data)
+        entry = {"chunk": index, "offset": offset, "nruns": len(starts)}
+        self._manifest.write(json.dumps(entry) + "\n")
+        self._sync(self._manifest)
+        self._done[index] = (offset, len(starts))
+
+    def load(
+        self, index: int, n: int, out: npt.NDArray[np.int32]
+    ) -> npt.NDArray[np.int32]:
+        """Load staged chunk with plan index `index` and length n."""
+        offset, nruns = self._done[index]
+        raw = np.fromfile(
+            self._directory / DATA,
+            dtype=np.int32,
+            count=2 * nruns,
+            offset=offset,
+        )
+        starts = raw[:nruns].astype(np.intp)
+        return from_runs(starts, raw[nruns:], n, out=out)
+
+    def close(self) -> None:
+        """Close checkpoint files."""
+        for fh in (self._data, self._manifest):
+            if fh is not None:
+                fh.close()
+        self._data = self._manifest = None
+
+    def remove(self) -> None:
+        """Close and remove the checkpoint directory."""
+        self.close()
+        if self._directory.exists():
+            shutil.rmtree(self._directory)
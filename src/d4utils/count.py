@@ -6,27 +6,60 @@ multiple d4 files.
 
 """
 
+import json
 import logging
 import pathlib
+from typing import Union
 
 import click
 import numpy as np
-import numpy.typing as npt
-import pandas as pd
-import pyd4
-from tqdm import tqdm
 
 from d4utils.arguments import outfile
-from d4utils.d4 import D4Container, iter_chunks, parse_region
+from d4utils.checkpoint import make_checkpoint
+from d4utils.d4 import D4Container, Region
+from d4utils.engine import (
+    EngineOptions,
+    WorkerTask,
+    process_chunks,
+    summarize_chunks,
+)
+from d4utils.kernels import CountAccumulator, accumulator_dtype
+from d4utils.metrics import JobReport
 from d4utils.options import (
+    checkpoint_option,
     chunk_size_option,
     cores_option,
+    engine_option,
+    executor_option,
+    histogram_max_option,
     max_coverage_option,
+    memory_budget_option,
+    metrics_interval_option,
+    metrics_out_option,
     min_coverage_option,
+    prefetch_option,
+    profile_option,
     regions_option,
+    resume_option,
+    sample_groups_option,
+    shard_option,
+    summary_option,
+    update_option,
+    window_size_option,
+    write_batch_option,
 )
 from d4utils.options import verbose_option as verbose
-from d4utils.queue import init_pool
+from d4utils.runs import RunCountAccumulator
+from d4utils.shard import check_shard_output, write_shard_manifest
+from d4utils.summary import HistogramSummary
+from d4utils.update import check_update, write_track_info
+from d4utils.worker import (
+    cached_d4,
+    get_container,
+    load_samples,
+    result_buffer,
+    scratch_buffer,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -37,53 +70,163 @@ logger = logging.getLogger(__name__)
 @outfile()
 @regions_option()
 @chunk_size_option()
+@memory_budget_option()
 @min_coverage_option()
 @max_coverage_option()
 @cores_option()
+@window_size_option()
+@prefetch_option()
+@write_batch_option()
+@profile_option()
+@metrics_out_option()
+@metrics_interval_option()
+@sample_groups_option()
+@engine_option()
+@executor_option()
+@checkpoint_option()
+@resume_option()
+@shard_option()
+@summary_option()
+@update_option()
+@histogram_max_option("number of files")
 def count(
     path: list[pathlib.Path],
     outfile: pathlib.Path,
-    regions: pd.DataFrame,
-    chunk_size: int,
+    regions: Union[list[Region], None],
+    chunk_size: Union[int, None],
+    memory_budget: Union[int, None],
     min_coverage: int,
     max_coverage: int,
     cores: int,
+    window_size: int,
+    prefetch: int,
+    write_batch: Union[int, None],
+    profile: bool,
+    metrics_out: Union[str, None],
+    metrics_interval: Union[float, None],
+    sample_groups: int,
+    engine: str,
+    executor: str,
+    checkpoint: bool,
+    resume: bool,
+    shard: Union[tuple[int, int], None],
+    summary: bool,
+    histogram_max: Union[int, None],
+    update: Union[pathlib.Path, None],
 ) -> None:
     """Count coverages."""
     d4container = D4Container(
         path, outfile=outfile, chunk_size=chunk_size, regions=regions
     )
+    d4container.engine = engine
+    d4container.shard = shard
+    if shard is not None:
+        check_shard_output(d4container)
+    d4container.update = update
     d4container.min_coverage = min_coverage
     d4container.max_coverage = max_coverage
+    nprevious = 0
+    if update is not None:
+        nprevious = check_update(d4container, "count")
 
     tqdm_disable = logger.getEffectiveLevel() > logging.INFO
 
-    pool = init_pool(cores)
-    futures = []
-    logger.info("Making chunks...")
-    for rname in iter_chunks(d4container.chroms, chunk_size, tqdm_disable):
-        args = d4container, rname
-        futures.append(pool.submit(process_region_chunk, args))
+    report = None
+    if profile or metrics_out is not None:
+        report = JobReport(metrics_out, metrics_interval)
+
+    histograms = None
+    if summary:
+        if shard is not None or checkpoint or resume:
+            msg = "--summary cannot be combined with --shard or checkpoints"
+            logging.error(msg)
+            raise ValueError(msg)
+        histograms = HistogramSummary(
+            outfile,
+            d4container.chroms,
+            d4container.task_regions,
+            nprevious + len(path) if histogram_max is None else histogram_max,
+        )
+
+    options = EngineOptions(
+        cores=cores,
+        window_size=window_size,
+        sample_groups=sample_groups,
+        memory_budget=memory_budget,
+        prefetch=prefetch,
+        write_batch=write_batch,
+        executor=executor,
+        report=report,
+        tqdm_disable=tqdm_disable,
+    )
+    if histograms is not None:
+        summarize_chunks(
+            d4container, process_region_chunk, histograms, options
+        )
+    else:
+        process_chunks(
+            d4container,
+            process_region_chunk,
+            options,
+            checkpoint=make_checkpoint(
+                d4container, "count", checkpoint, resume
+            ),
+        )
+    if shard is not None:
+        write_shard_manifest(d4container, "count")
+    elif not summary:
+        write_track_info(d4container, "count")
+    if profile:
+        click.echo(json.dumps(report.report(), indent=2), err=True)
 
-    logger.info("Processing futures...")
-    writer = d4container.writer
-    for x in tqdm(futures, disable=tqdm_disable):
-        rname, y = x.result()
-        chrom_name, begin, end = parse_region(rname)
-        writer.write_np_array(chrom_name, begin, y)
 
+def process_region_chunk(task: WorkerTask) -> int:
+    """Process region chunk.
 
-def process_region_chunk(
-    args: tuple[D4Container, str],
-) -> tuple[str, npt.NDArray[np.int_]]:
-    """Process region chunk."""
-    d4c, rname = args
-    for i, p in enumerate(d4c.path):
-        fh = pyd4.D4File(p)
-        x = fh.load_to_np(rname)
-        y = ((x >= d4c.min_coverage) & (x <= d4c.max_coverage)).astype(int)
-        if i == 0:
-            data = y
-        else:
-            data = data + y
-    return rname, data
+    The job configuration is taken from the worker state set up by
+    the pool initializer, and the result for the task's sample range
+    is written to the shared memory slot given by the task. The first
+    sample group also adds the counts of the track being updated, if
+    any. Returns a bound on the partial count.
+    """
+    d4c = get_container()
+    slot, chrom_index, begin, end, sample_begin, sample_end = task
+    chrom_name, _ = d4c.chroms[chrom_index]
+    n = end - begin
+    nsamples = sample_end - sample_begin
+    out = result_buffer(slot)[:n]
+    previous = None
+    if d4c.update is not None and sample_begin == 0:
+        update = cached_d4(d4c.update)
+        previous = update.load(
+            chrom_name, begin, end, out=scratch_buffer(n, key="update")
+        )
+        if n > 0:
+            nsamples += max(int(previous.max()), 0)
+    if d4c.engine == "runs":
+        acc = RunCountAccumulator(
+            out,
+            nsamples,
+            d4c.min_coverage,
+            d4c.max_coverage,
+            diff=scratch_buffer(n, np.int64, "diff"),
+            mask=scratch_buffer(n, np.bool_, "mask"),
+        )
+    else:
+        acc = CountAccumulator(
+            out,
+            nsamples,
+            d4c.min_coverage,
+            d4c.max_coverage,
+            acc=scratch_buffer(
+                n, accumulator_dtype(nsamples, 1, signed=False), "count"
+            ),
+            mask=scratch_buffer(n, np.bool_, "mask"),
+        )
+    if previous is not None:
+        acc.add_counts(previous)
+    paths = d4c.path[sample_begin:sample_end]
+    for x in load_samples(paths, chrom_name, begin, end):
+        acc.add(x)
+    acc.result()
+    return acc.bound
@@ -1,17 +1,30 @@
 """D4 utility classes."""
 
+import copy
+import gzip
 import logging
 import re
 from pathlib import Path
-from typing import Any, Iterable, Union
+from typing import Any, Iterable, Iterator, Sequence, Union
 
 import numpy as np
+import numpy.typing as npt
 import pyd4
-from pandas import DataFrame
 from tqdm import tqdm
 
+from d4utils.sinks import Sink, get_sink
+
 logger = logging.getLogger(__name__)
 
+# A chunk task is (chromosome index, begin, end)
+ChunkTask = tuple[int, int, int]
+# Record dtype of a chunk plan, one row per chunk task
+CHUNK_DTYPE = np.dtype(
+    [("chrom", np.int32), ("begin", np.int64), ("end", np.int64)]
+)
+# A region is (chromosome name, begin, end); end may be np.inf
+Region = tuple[str, int, Union[int, float]]
+
 
 def parse_region(
     region: str,
@@ -30,25 +43,124 @@ def parse_region(
     raise ValueError("Invalid region argument: %s" % region)
 
 
-def make_chunks(begin: int, end: int, size: int) -> Iterable[tuple[int, int]]:
-    """Make chunks of a given size."""
-    pos = np.arange(begin, end, size)
-    begin_list = pos
-    end_list = pos[1 : len(pos)]  # noqa: E203
-    end_list = np.append(end_list, end)
-    for begin, end in zip(begin_list, end_list):
-        yield begin, end
+def read_bed(path: Union[str, Path]) -> list[Region]:
+    """Read the first three columns of a, possibly gzipped, bed file.
+
+    Blank lines and comment, track and browser lines are skipped.
+    """
+    opener = gzip.open if str(path).endswith(".gz") else open
+    regions = []
+    with opener(path, "rt") as fh:
+        for line in fh:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            chrom, begin, end = line.rstrip("\r\n").split("\t")[0:3]
+            regions.append((chrom, int(begin), int(end)))
+    return regions
+
+
+def merge_intervals(
+    intervals: Iterable[tuple[int, int]],
+) -> list[tuple[int, int]]:
+    """Sort and merge overlapping or adjacent intervals.
+
+    >>> merge_intervals([(50, 60), (0, 10), (5, 20), (20, 30)])
+    [(0, 30), (50, 60)]
+    """
+    merged: list[tuple[int, int]] = []
+    for begin, end in sorted(intervals):
+        if merged and begin <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((begin, end))
+    return merged
+
+
+def _count_chunks(r: npt.NDArray[np.int64], chunk_size: int) -> Any:
+    """Return number of chunks of each region in a region array."""
+    nchunks = -(-(r[:, 2] - r[:, 1]) // chunk_size)
+    nchunks[nchunks < 0] = 0
+    return nchunks
+
+
+def plan_chunks(
+    regions: Sequence[ChunkTask], chunk_size: int
+) -> npt.NDArray[Any]:
+    """Plan chunks of regions as a structured array.
 
+    Regions are (chromosome index, begin, end) tuples. The plan is a
+    record array with fields chrom, begin and end, one row per chunk,
+    in region order. It is computed without a Python-level loop and
+    can be sliced, sorted and serialised like any numpy array.
 
-def iter_chunks(
-    chroms: list[tuple[str, int]], chunk_size: int, tqdm_disable: bool
-) -> Iterable[str]:
-    """Iterate over chunks."""
-    for chrom_name, end in (pbar := tqdm(chroms, disable=tqdm_disable)):
-        pbar.set_description(f"Processing chromosome {chrom_name}")
-        for rbegin, rend in make_chunks(0, end, chunk_size):
-            rname = f"{chrom_name}:{rbegin}-{rend}"
-            yield rname
+    >>> plan_chunks([(0, 0, 25), (1, 5, 15)], 10).tolist()
+    [(0, 0, 10), (0, 10, 20), (0, 20, 25), (1, 5, 15)]
+    """
+    r = np.asarray(regions, dtype=np.int64).reshape(-1, 3)
+    nchunks = _count_chunks(r, chunk_size)
+    index = np.repeat(np.arange(r.shape[0]), nchunks)
+    offset = np.arange(index.shape[0]) - np.repeat(
+        np.cumsum(nchunks) - nchunks, nchunks
+    )
+    plan = np.empty(index.shape[0], dtype=CHUNK_DTYPE)
+    plan["chrom"] = r[index, 0]
+    plan["begin"] = r[index, 1] + offset * chunk_size
+    plan["end"] = np.minimum(plan["begin"] + chunk_size, r[index, 2])
+    return plan
+
+
+def chunk_regions(
+    regions: Sequence[ChunkTask], chunk_size: int
+) -> npt.NDArray[np.intp]:
+    """Return index of the region of each chunk planned by plan_chunks.
+
+    >>> chunk_regions([(0, 0, 25), (1, 5, 15)], 10).tolist()
+    [0, 0, 0, 1]
+    """
+    r = np.asarray(regions, dtype=np.int64).reshape(-1, 3)
+    return np.repeat(np.arange(r.shape[0]), _count_chunks(r, chunk_size))
+
+
+def shard_regions(
+    regions: Sequence[ChunkTask], index: int, count: int
+) -> list[ChunkTask]:
+    """Return the part of regions covered by shard `index` of `count`.
+
+    Shards are numbered from 1. The regions are split at base
+    boundaries into `count` contiguous shards of about the same number
+    of bases, so that the split does not depend on the chunk size and
+    the shards are in genome order.
+
+    >>> shard_regions([(0, 0, 10), (1, 0, 10)], 2, 3)
+    [(0, 6, 10), (1, 0, 3)]
+    """
+    total = sum(end - begin for _, begin, end in regions)
+    low = total * (index - 1) // count
+    high = total * index // count
+    shard = []
+    offset = 0
+    for chrom_index, begin, end in regions:
+        b = max(low - offset, 0)
+        e = min(high - offset, end - begin)
+        if b < e:
+            shard.append((chrom_index, begin + b, begin + e))
+        offset += end - begin
+    return shard
+
+
+def iter_plan(
+    plan: npt.NDArray[Any],
+    chroms: list[tuple[str, int]],
+    tqdm_disable: bool,
+) -> Iterable[ChunkTask]:
+    """Iterate over a chunk plan as (chromosome index, begin, end)."""
+    pbar = tqdm(plan.tolist(), disable=tqdm_disable, unit="chunk")
+    current = None
+    for chrom_index, begin, end in pbar:
+        if chrom_index != current:
+            current = chrom_index
+            pbar.set_description(f"Processing chromosome {chroms[current][0]}")
+        yield chrom_index, begin, end
 
 
 class D4Container:
@@ -60,7 +172,7 @@ class D4Container:
         *,
         outfile: Path,
         chunk_size: Union[Any, int] = None,
-        regions: Union[Any, DataFrame] = None,
+        regions: Union[list[Region], None] = None,
         concat: bool = False,
     ):
         """Create a D4Container."""
@@ -68,15 +180,24 @@ class D4Container:
         self._outfile = outfile
         self._min_coverage = 0
         self._max_coverage = np.inf
+        self._engine = "dense"
+        self._shard: Union[tuple[int, int], None] = None
+        self._update: Union[Path, None] = None
         self._chunk_size = chunk_size
         self._writer = None
         self._set_chroms(regions, concat)
 
     def _set_chroms(
-        self, regions: Union[None, DataFrame], concat: bool
+        self, regions: Union[list[Region], None], concat: bool
     ) -> None:
-        """Set chroms."""
+        """Set chroms and regions.
+
+        Regions are clipped to the reference chromosome lengths, sorted
+        in reference order and merged. Only chromosomes that overlap a
+        region are kept.
+        """
         self._chroms = []
+        self._regions = []
         if concat:
             chroms = [pyd4.D4File(x).chroms() for x in self.path]
         else:
@@ -84,40 +205,45 @@ class D4Container:
         chromlen = {k: v for k, v in chroms}
         if regions is None:
             self._chroms = chroms
-        else:
-            for _, row in regions.iterrows():
-                chrom_name, begin, end = row
-                if chrom_name not in chromlen:
-                    logger.warning(
-                        "region %s:%s-%s not in chromosome list; skipping",
-                        chrom_name,
-                        begin,
-                        end,
-                    )
-                    continue
-                if (begin != 0) or (end < chromlen[chrom_name]):
-                    s = (
-                        "Region %s:%s-%s smaller than / outside "
-                        + "reference chromosome (0-%s). "
-                        + "This is currently unsupported; "
-                        + "using entire chromosome."
-                    )
-                    logger.warning(
-                        s, chrom_name, begin, end, chromlen[chrom_name]
-                    )
-                    begin = 0
-                    end = chromlen[chrom_name]
-                if end > chromlen[chrom_name]:
-                    logger.warning(
-                        "region %s:%s-%s end larger than reference "
-                        + "chromosome length (%s); resetting",
-                        chrom_name,
-                        begin,
-                        end,
-                        chromlen[chrom_name],
-                    )
-                    end = chromlen[chrom_name]
-                self._chroms.append((chrom_name, end))
+            self._regions = [
+                (i, 0, length) for i, (_, length) in enumerate(chroms)
+            ]
+            return
+        intervals: dict[str, list[tuple[int, int]]] = {}
+        for chrom_name, begin, end in regions:
+            if chrom_name not in chromlen:
+                logger.warning(
+                    "region %s:%s-%s not in chromosome list; skipping",
+                    chrom_name,
+                    begin,
+                    end,
+                )
+                continue
+            if end > chromlen[chrom_name]:
+                logger.warning(
+                    "region %s:%s-%s end larger than reference "
+                    + "chromosome length (%s); resetting",
+                    chrom_name,
+                    begin,
+                    end,
+                    chromlen[chrom_name],
+                )
+                end = chromlen[chrom_name]
+            begin = max(int(begin), 0)
+            end = int(end)
+            if begin >= end:
+                logger.warning(
+                    "region %s:%s-%s is empty; skipping",
+                    chrom_name,
+                    begin,
+                    end,
+                )
+                continue
+            intervals.setdefault(chrom_name, []).append((begin, end))
+        self._chroms = [(k, v) for k, v in chroms if k in intervals]
+        for i, (chrom_name, _) in enumerate(self._chroms):
+            for begin, end in merge_intervals(intervals[chrom_name]):
+                self._regions.append((i, begin, end))
 
     @property
     def path(self) -> list[Path]:
@@ -134,6 +260,40 @@ class D4Container:
         """Return chroms as chromosome name and reference chromosome length."""
         return self._chroms
 
+    @property
+    def regions(self) -> list[ChunkTask]:
+        """Return sorted, merged regions as chromosome index, begin, end."""
+        return self._regions
+
+    @property
+    def shard(self) -> Union[tuple[int, int], None]:
+        """Return shard as (index, count), numbered from 1."""
+        return self._shard
+
+    @shard.setter
+    def shard(self, value: Union[tuple[int, int], None]) -> None:
+        """Set shard."""
+        if value is not None and not 1 <= value[0] <= value[1]:
+            raise ValueError(f"Invalid shard: {value[0]}/{value[1]}")
+        self._shard = value
+
+    @property
+    def update(self) -> Union[Path, None]:
+        """Return previous track that the new samples are added to."""
+        return self._update
+
+    @update.setter
+    def update(self, value: Union[Path, None]) -> None:
+        """Set previous track to update."""
+        self._update = value
+
+    @property
+    def task_regions(self) -> list[ChunkTask]:
+        """Return regions processed by this job, restricted to the shard."""
+        if self._shard is None:
+            return self._regions
+        return shard_regions(self._regions, *self._shard)
+
     @property
     def min_coverage(self) -> int:
         """Return min coverage."""
@@ -154,16 +314,66 @@ class D4Container:
         """Set max coverage."""
         self._max_coverage = value
 
+    @property
+    def engine(self) -> str:
+        """Return reduction engine, dense or the experimental runs."""
+        return self._engine
+
+    @engine.setter
+    def engine(self, value: str) -> None:
+        """Set reduction engine."""
+        if value not in ("dense", "runs"):
+            raise ValueError(f"Invalid engine: {value}")
+        self._engine = value
+
     @property
     def chunk_size(self) -> Union[Any, int]:
         """Return chunk size."""
         return self._chunk_size
 
+    @chunk_size.setter
+    def chunk_size(self, value: int) -> None:
+        """Set chunk size."""
+        self._chunk_size = value
+
     @property
-    def writer(self) -> pyd4.D4Writer:
+    def writer(self) -> Union[pyd4.D4Writer, Sink]:
         """Return writer."""
-        return (
-            pyd4.D4Builder(str(self.outfile))
-            .add_chroms(self.chroms)
-            .get_writer()
+        return self.get_writer(self.outfile)
+
+    def get_writer(self, path: Path) -> Union[pyd4.D4Writer, Sink]:
+        """Return writer for a file with the container's chromosomes.
+
+        The writer is a sink if the extension of path is one of a
+        sink's, see `d4utils.sinks`, and a d4 writer otherwise.
+        """
+        sink = get_sink(path, self.chroms)
+        if sink is not None:
+            return sink
+        return pyd4.D4Builder(str(path)).add_chroms(self.chroms).get_writer()
+
+    def stream(
+        self, statistic: str = "sum", **kwargs: Any
+    ) -> Iterator[tuple[str, int, npt.NDArray[Any]]]:
+        """Yield reduced chunks of the container in genome order.
+
+        `statistic` is "sum" or "count", the latter counting samples
+        with coverage in [min_coverage, max_coverage]. Chunks are
+        processed by the same engine as the commands, with keyword
+        arguments such as `cores` taken as `EngineOptions`, and
+        yielded as (chromosome name, begin, int32 values) without
+        writing a d4 file. The values are copies, which stay valid
+        after the stream is exhausted or closed.
+        """
+        # Imported here, as the engine and commands import this module
+        from d4utils.count import process_region_chunk as count_chunk
+        from d4utils.engine import EngineOptions, stream_chunks
+        from d4utils.sum import process_region_chunk as sum_chunk
+
+        funcs = {"sum": sum_chunk, "count": count_chunk}
+        if statistic not in funcs:
+            raise ValueError(f"Invalid statistic: {statistic}")
+        # Plan the chunk size on a copy, leaving this container as is
+        return stream_chunks(
+            copy.copy(self), funcs[statistic], EngineOptions(**kwargs)
         )
@@ -0,0 +1,635 @@
+"""Chunk processing engine shared by the sum and count commands.
+
+The engine submits chunk tasks to a pool and writes the
+results, which workers store in a shared memory ring, to the output
+d4 file in genome order.
+
+"""
+
+import contextlib
+import dataclasses
+import functools
+import logging
+from pathlib import Path
+from typing import Any, Callable, Iterator, Sequence, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from d4utils.checkpoint import Checkpoint
+from d4utils.d4 import D4Container, chunk_regions, iter_plan, plan_chunks
+from d4utils.kernels import INT32_MAX, check_int32_range, histogram
+from d4utils.metrics import JobReport, profiled
+from d4utils.queue import init_pool, stream_ordered
+from d4utils.shm import SharedBufferRing
+from d4utils.sinks import Sink
+from d4utils.summary import HistogramSummary
+from d4utils.worker import (
+    JobContext,
+    bind_context,
+    get_container,
+    get_sink,
+    init_worker,
+    result_buffer,
+)
+from d4utils.writer import WRITER_PART_SIZE, BatchWriter
+
+logger = logging.getLogger(__name__)
+
+# A worker task is (slot, chrom_index, begin, end, sample_begin, sample_end)
+WorkerTask = tuple[int, int, int, int, int, int]
+
+
+def split_samples(nsamples: int, groups: int) -> list[tuple[int, int]]:
+    """Split sample indices into at most `groups` contiguous ranges.
+
+    >>> split_samples(5, 2)
+    [(0, 2), (2, 5)]
+    >>> split_samples(2, 4)
+    [(0, 1), (1, 2)]
+    """
+    groups = max(1, min(groups, nsamples))
+    bounds = np.linspace(0, nsamples, groups + 1).round().astype(int)
+    return [(int(b), int(e)) for b, e in zip(bounds[:-1], bounds[1:])]
+
+
+def tree_reduce(arrays: list[npt.NDArray[Any]]) -> npt.NDArray[Any]:
+    """Sum arrays pairwise in place and return the first array.
+
+    >>> x = [np.array([1, 2]), np.array([3, 4]), np.array([5, 6])]
+    >>> tree_reduce(x)
+    array([ 9, 12])
+    """
+    step = 1
+    while step < len(arrays):
+        for i in range(0, len(arrays) - step, 2 * step):
+            np.add(arrays[i], arrays[i + step], out=arrays[i])
+        step *= 2
+    return arrays[0]
+
+
+# Target number of base x sample values decoded per task, large enough
+# to amortize the per-task overhead of opening and decoding each file
+TASK_WORK = 2**26
+MIN_CHUNK_SIZE = 10_000
+MAX_CHUNK_SIZE = 10_000_000
+
+
+def worker_bytes_per_base(
+    engine: str, prefetch: int = 1, reduce_bytes: Union[int, None] = None
+) -> int:
+    """Return worker scratch memory per base in a chunk.
+
+    Workers decode into `prefetch` + 1 int32 buffers and reduce with
+    `reduce_bytes` of scratch, by default that of a compact accumulator
+    and a boolean mask (dense) or an int64 difference array and a
+    boolean mask (runs).
+    """
+    decode = 4 * (prefetch + 1)
+    if reduce_bytes is not None:
+        return decode + reduce_bytes
+    if engine == "runs":
+        return decode + 8 + 1
+    return decode + 2 + 1
+
+
+def estimate_memory(
+    chunk_size: int,
+    cores: int,
+    nslots: int,
+    engine: str = "dense",
+    prefetch: int = 1,
+    reduce_bytes: Union[int, None] = None,
+) -> int:
+    """Estimate chunk buffer memory of a job in bytes.
+
+    >>> estimate_memory(1000, cores=2, nslots=8)
+    54000
+    """
+    slot_bytes = np.dtype(np.int32).itemsize
+    worker_bytes = worker_bytes_per_base(engine, prefetch, reduce_bytes)
+    per_base = nslots * slot_bytes + cores * worker_bytes
+    return chunk_size * per_base
+
+
+def plan_chunk_size(
+    *,
+    nsamples: int,
+    nbases: int,
+    cores: int,
+    nslots: int,
+    engine: str = "dense",
+    memory_budget: Union[int, None] = None,
+    prefetch: int = 1,
+    reduce_bytes: Union[int, None] = None,
+) -> int:
+    """Plan a chunk size from the job size and memory budget.
+
+    The chunk size is chosen so that each task decodes about
+    `TASK_WORK` values, which makes chunks shorter as the number of
+    samples grows, and so that there are at least eight chunks per
+    core to keep workers busy. It is then capped by the memory budget,
+    given the number of result slots and per-worker scratch buffers.
+
+    >>> plan_chunk_size(nsamples=3, nbases=3 * 10**9, cores=4, nslots=16)
+    10000000
+    >>> plan_chunk_size(nsamples=2000, nbases=3 * 10**9, cores=4, nslots=16)
+    33000
+    """
+    size = TASK_WORK // max(nsamples, 1)
+    size = min(size, max(nbases // (8 * cores), 1))
+    size = max(min(size, MAX_CHUNK_SIZE), MIN_CHUNK_SIZE)
+    reason = "task work"
+    if memory_budget is not None:
+        per_base = estimate_memory(
+            1, cores, nslots, engine, prefetch, reduce_bytes
+        )
+        limit = memory_budget // per_base
+        if limit < size:
+            size, reason = limit, "memory budget"
+        if size < MIN_CHUNK_SIZE:
+            logger.warning(
+                "Memory budget %i bytes allows chunks of only %i bases",
+                memory_budget,
+                size,
+            )
+    if size >= 1000:
+        size -= size % 1000
+    size = max(size, 1)
+    logger.info(
+        "Planned chunk size %i (limited by %s) for %i samples, %i bases, "
+        "%i cores and %i result slots; estimated memory %i bytes",
+        size,
+        reason,
+        nsamples,
+        nbases,
+        cores,
+        nslots,
+        estimate_memory(size, cores, nslots, engine, prefetch, reduce_bytes),
+    )
+    return size
+
+
+def choose_executor(
+    executor: str, *, cores: int, nchunks: int, nsamples: int, nbases: int
+) -> str:
+    """Resolve the "auto" executor from the job size.
+
+    Jobs on one core or with a single chunk run serially, jobs with
+    less than `TASK_WORK` values to decode per core run on threads,
+    which start instantly, and larger jobs on processes, since pyd4
+    holds the GIL while decoding. Other executors are returned as is.
+
+    >>> choose_executor("auto", cores=1, nchunks=9, nsamples=9, nbases=9)
+    'serial'
+    >>> choose_executor("auto", cores=4, nchunks=9, nsamples=9, nbases=9)
+    'thread'
+    >>> choose_executor("auto", cores=4, nchunks=9, nsamples=9, nbases=2**30)
+    'process'
+    """
+    if executor != "auto":
+        return executor
+    if cores == 1 or nchunks <= 1:
+        return "serial"
+    if nsamples * nbases < cores * TASK_WORK:
+        return "thread"
+    return "process"
+
+
+def stage_timer(report: Union[JobReport, None], name: str) -> Any:
+    """Return timer of a parent stage, or a null context without report."""
+    if report is None:
+        return contextlib.nullcontext()
+    return report.parent.timer(name)
+
+
+def sink_chunk(func: Callable[[WorkerTask], Any], task: WorkerTask) -> Any:
+    """Run func on a task and write its result to the job's sink."""
+    bound = func(task)
+    slot, chrom_index, begin, end, _, _ = task
+    data = result_buffer(slot)[: end - begin]
+    if data.any():
+        chrom_name = get_container().chroms[chrom_index][0]
+        get_sink().write_np_array(chrom_name, begin, data)
+    return bound
+
+
+def histogram_chunk(
+    func: Callable[[WorkerTask], Any], max_value: int, task: WorkerTask
+) -> npt.NDArray[np.int64]:
+    """Run func on a task and return the histogram of its result."""
+    func(task)
+    slot, _, begin, end, _, _ = task
+    return histogram(result_buffer(slot)[: end - begin], max_value)
+
+
+@dataclasses.dataclass
+class EngineOptions:
+    """Options of a chunk processing job."""
+
+    # Number of workers
+    cores: int = 1
+    # Chunks in flight; four per core by default
+    window_size: Union[int, None] = None
+    # Number of disjoint sample groups every chunk is split into
+    sample_groups: int = 1
+    # Memory budget in bytes for planning the chunk size
+    memory_budget: Union[int, None] = None
+    # Samples decoded ahead of the one being accumulated
+    prefetch: int = 1
+    # Reduction scratch bytes per base of a worker; by default those of
+    # the sum and count accumulators
+    reduce_bytes: Union[int, None] = None
+    # Bases per write batch; one writer part per core by default, and
+    # 0 to write every chunk directly
+    write_batch: Union[int, None] = None
+    # Executor of the tasks, one of `EXECUTORS`
+    executor: str = "auto"
+    # Report collecting profiles and stage timings of the job
+    report: Union[JobReport, None] = None
+    tqdm_disable: bool = True
+
+    def __post_init__(self) -> None:
+        """Resolve defaults that depend on the number of cores."""
+        if self.window_size is None:
+            self.window_size = 4 * self.cores
+        if self.write_batch is None:
+            self.write_batch = self.cores * WRITER_PART_SIZE
+
+
+def plan_job(
+    d4container: D4Container, options: EngineOptions, ntracks: int = 1
+) -> npt.NDArray[Any]:
+    """Plan the chunks of a job with `ntracks` result tracks per chunk.
+
+    If the container has no chunk size, one is planned with
+    `plan_chunk_size`. Warns if the estimated chunk buffer memory
+    exceeds the memory budget.
+    """
+    assert options.window_size is not None
+    groups = split_samples(len(d4container.path), options.sample_groups)
+    nslots = options.window_size * len(groups) * ntracks
+    budget = options.memory_budget
+    if d4container.chunk_size is None:
+        d4container.chunk_size = plan_chunk_size(
+            nsamples=len(d4container.path),
+            nbases=sum(e - b for _, b, e in d4container.task_regions),
+            cores=options.cores,
+            nslots=nslots,
+            engine=d4container.engine,
+            memory_budget=budget,
+            prefetch=options.prefetch,
+            reduce_bytes=options.reduce_bytes,
+        )
+    peak = estimate_memory(
+        d4container.chunk_size,
+        options.cores,
+        nslots,
+        d4container.engine,
+        options.prefetch,
+        options.reduce_bytes,
+    )
+    if budget is not None and peak > budget:
+        logger.warning(
+            "Estimated chunk buffer memory %i bytes exceeds budget %i "
+            "bytes; lower --chunk-size or --window-size",
+            peak,
+            budget,
+        )
+    plan = plan_chunks(d4container.task_regions, d4container.chunk_size)
+    logger.info(
+        "Processing %i chunks of size %i (about %i bytes of chunk buffers)",
+        plan.shape[0],
+        d4container.chunk_size,
+        peak,
+    )
+    return plan
+
+
+def run_jobs(
+    d4container: D4Container,
+    func: Callable[[WorkerTask], Any],
+    plan: npt.NDArray[Any],
+    todo: list[int],
+    options: EngineOptions,
+    *,
+    ntracks: int = 1,
+    sink: Union[Sink, None] = None,
+    **config: Any,
+) -> Iterator[tuple[int, Sequence[WorkerTask], list[Any], SharedBufferRing]]:
+    """Run the chunks `todo` of a plan and yield their results in order.
+
+    Every chunk is submitted as one task per sample group to a pool on
+    the executor, chosen by `choose_executor` for "auto", and yielded
+    as (plan index, tasks, task results, ring) once all its tasks are
+    done. The result slots of the tasks are only valid until the
+    generator is resumed. A `sink` is passed to the workers with the
+    job context, once per worker rather than with every task. With a
+    report, tasks are profiled, and the job is started in the report
+    with `config` added to its options.
+    """
+    chroms = d4container.chroms
+    window_size = options.window_size
+    assert window_size is not None
+    groups = split_samples(len(d4container.path), options.sample_groups)
+    executor = choose_executor(
+        options.executor,
+        cores=options.cores,
+        nchunks=len(todo),
+        nsamples=len(d4container.path),
+        nbases=int((plan["end"] - plan["begin"]).sum()),
+    )
+    report = options.report
+    if report is not None:
+        func = functools.partial(profiled, func)
+        report.start(
+            samples=len(d4container.path),
+            chunks=len(todo),
+            chunk_size=d4container.chunk_size,
+            cores=options.cores,
+            window_size=window_size,
+            sample_groups=len(groups),
+            prefetch=options.prefetch,
+            executor=executor,
+            **config,
+        )
+    logger.info(
+        "Running %i worker(s) on the %s executor with window size %i and "
+        "%i sample group(s)",
+        options.cores,
+        executor,
+        window_size,
+        len(groups),
+    )
+    selected = set(todo)
+    tasks = (
+        task
+        for i, task in enumerate(iter_plan(plan, chroms, options.tqdm_disable))
+        if i in selected
+    )
+    jobs = (
+        [
+            ((i % window_size) * len(groups) + j, *task, sbegin, send)
+            for j, (sbegin, send) in enumerate(groups)
+        ]
+        for i, task in enumerate(tasks)
+    )
+    nslots = window_size * len(groups)
+    size = ntracks * d4container.chunk_size
+    with SharedBufferRing(nslots, size, np.int32) as ring:
+        if executor == "process":
+            context = JobContext(
+                d4container, ring.spec, options.prefetch, sink
+            )
+            pool = init_pool(
+                options.cores,
+                executor=executor,
+                initializer=init_worker,
+                initargs=(context,),
+            )
+        else:
+            # Tasks run in this process, which may run other jobs
+            context = JobContext(d4container, ring, options.prefetch, sink)
+            func = bind_context(context, func)
+            pool = init_pool(options.cores, executor=executor)
+        try:
+            results = stream_ordered(
+                pool,
+                func,
+                jobs,
+                window_size,
+                None if report is None else report.parent,
+            )
+            for index, (job, bounds) in zip(todo, results):
+                if report is not None:
+                    _, _, begin, end, _, _ = job[0]
+                    bounds = [report.add_task(x) for x in bounds]
+                    report.add_chunk(end - begin)
+                yield index, job, bounds, ring
+        finally:
+            pool.shutdown()
+
+
+def reduce_job(
+    ring: SharedBufferRing,
+    job: Sequence[WorkerTask],
+    bounds: list[int],
+    ntracks: int = 1,
+) -> npt.NDArray[Any]:
+    """Reduce the partial results of a chunk to a (ntracks, n) array.
+
+    The partials are combined in place in the ring with a pairwise tree
+    reduction; if their summed bounds exceed the int32 range, the
+    reduction is done in int64 and range checked.
+    """
+    _, _, begin, end, _, _ = job[0]
+    n = end - begin
+    parts = [ring[task[0]].reshape(ntracks, -1)[:, :n] for task in job]
+    if len(parts) > 1 and sum(bounds) > INT32_MAX:
+        parts = [x.astype(np.int64) for x in parts]
+    data = tree_reduce(parts)
+    check_int32_range(data)
+    return data
+
+
+def stream_chunks(
+    d4container: D4Container,
+    func: Callable[[WorkerTask], Any],
+    options: Union[EngineOptions, None] = None,
+    *,
+    ntracks: int = 1,
+) -> Iterator[tuple[str, int, npt.NDArray[Any]]]:
+    """Process all chunks of a container and yield the results.
+
+    Chunks are processed as by `process_chunks`, but yielded in genome
+    order as (chromosome name, begin, values) instead of being
+    written, where values has one row per track for several `ntracks`.
+    Values are int32 copies owned by the caller, as the shared result
+    buffers are reused for later chunks and released when the
+    generator finishes.
+    """
+    if options is None:
+        options = EngineOptions()
+    plan = plan_job(d4container, options, ntracks)
+    todo = list(range(plan.shape[0]))
+    for _, job, bounds, ring in run_jobs(
+        d4container, func, plan, todo, options, ntracks=ntracks
+    ):
+        _, chrom_index, begin, _, _, _ = job[0]
+        data = reduce_job(ring, job, bounds, ntracks)
+        values = data.astype(np.int32)
+        yield (
+            d4container.chroms[chrom_index][0],
+            begin,
+            values if ntracks > 1 else values[0],
+        )
+    if options.report is not None:
+        options.report.write()
+
+
+def process_chunks(
+    d4container: D4Container,
+    func: Callable[[WorkerTask], Any],
+    options: Union[EngineOptions, None] = None,
+    *,
+    checkpoint: Union[Checkpoint, None] = None,
+    outfiles: Union[list[Path], None] = None,
+) -> None:
+    """Process all chunks of a container and write the results.
+
+    `func` is called in a worker with a (slot, chrom_index, begin,
+    end, sample_begin, sample_end) task, writes the int32 result for
+    the sample range to the first `end - begin` elements of result
+    slot `slot` and returns a bound on its absolute value. With several
+    `outfiles`, the slot holds one row of chunk size elements per
+    outfile; by default the container's outfile is written.
+
+    Chunks are reduced over sample groups and written in genome order,
+    through batch writers or the sink of the outfile's extension;
+    tracks that are zero throughout are not written. With a
+    `checkpoint`, written chunks are staged, chunks staged by an
+    interrupted run are read back instead of recomputed, and the
+    checkpoint is removed once the output is closed.
+    """
+    if options is None:
+        options = EngineOptions()
+    report = options.report
+    chroms = d4container.chroms
+    groups = split_samples(len(d4container.path), options.sample_groups)
+    if outfiles is None:
+        outfiles = [d4container.outfile]
+    ntracks = len(outfiles)
+    if checkpoint is not None and checkpoint.chunk_size is not None:
+        if d4container.chunk_size is None:
+            d4container.chunk_size = checkpoint.chunk_size
+    plan = plan_job(d4container, options, ntracks)
+    done: set[int] = set()
+    if checkpoint is not None:
+        checkpoint.open(d4container.chunk_size)
+        done = set(checkpoint.done)
+        # The output is rewritten from the staged and computed chunks
+        for fn in outfiles:
+            if not Path(fn).is_dir():
+                Path(fn).unlink(missing_ok=True)
+    todo = [i for i in range(plan.shape[0]) if i not in done]
+    write_batch = options.write_batch
+    assert write_batch is not None
+    writers = [d4container.get_writer(fn) for fn in outfiles]
+    if write_batch > 0:
+        writers = [
+            w if isinstance(w, Sink) else BatchWriter(w, write_batch)
+            for w in writers
+        ]
+    # Parallel sinks are written by the workers
+    parallel = (
+        len(writers) == 1
+        and len(groups) == 1
+        and isinstance(writers[0], Sink)
+        and writers[0].parallel
+    )
+    sink = None
+    if parallel:
+        sink = writers[0]
+        assert isinstance(sink, Sink)
+        func = functools.partial(sink_chunk, func)
+    staged = np.empty(
+        ntracks * d4container.chunk_size if done else 0, np.int32
+    )
+
+    def write(chrom_index: int, begin: int, data: npt.NDArray) -> None:
+        """Write the tracks of a chunk to the writers."""
+        with stage_timer(report, "write"):
+            for writer, track in zip(writers, data):
+                if not track.any():
+                    if report is not None:
+                        report.parent.count("empty_tracks")
+                    continue
+                chrom_name = chroms[chrom_index][0]
+                writer.write_np_array(chrom_name, begin, track)
+
+    position = 0
+
+    def write_staged(stop: int) -> None:
+        """Write staged chunks from position up to stop."""
+        nonlocal position
+        assert checkpoint is not None
+        for i in range(position, stop):
+            chrom_index, begin, end = plan[i].tolist()
+            n = end - begin
+            with stage_timer(report, "checkpoint"):
+                data = checkpoint.load(i, ntracks * n, staged)
+            write(chrom_index, begin, data.reshape(ntracks, n))
+        position = stop
+
+    for index, job, bounds, ring in run_jobs(
+        d4container,
+        func,
+        plan,
+        todo,
+        options,
+        ntracks=ntracks,
+        sink=sink,
+        write_batch=write_batch,
+    ):
+        _, chrom_index, begin, _, _, _ = job[0]
+        if done:
+            write_staged(index)
+        with stage_timer(report, "reduce"):
+            data = reduce_job(ring, job, bounds, ntracks)
+        if not parallel:
+            write(chrom_index, begin, data)
+        if checkpoint is not None:
+            with stage_timer(report, "checkpoint"):
+                checkpoint.stage(index, data.ravel())
+        position = index + 1
+    if done:
+        write_staged(plan.shape[0])
+    with stage_timer(report, "close"):
+        for writer in writers:
+            writer.close()
+    if checkpoint is not None:
+        checkpoint.remove()
+    if report is not None:
+        report.write()
+
+
+def summarize_chunks(
+    d4container: D4Container,
+    func: Callable[[WorkerTask], Any],
+    summary: HistogramSummary,
+    options: Union[EngineOptions, None] = None,
+) -> None:
+    """Process all chunks of a container and write a histogram summary.
+
+    Chunks are processed as by `process_chunks`, but no track is
+    written. Instead, workers return the histogram of each chunk, which
+    is added to the summary of the chunk's region; only with several
+    sample groups is the histogram computed in the parent after the
+    reduction.
+    """
+    if options is None:
+        options = EngineOptions()
+    report = options.report
+    groups = split_samples(len(d4container.path), options.sample_groups)
+    if len(groups) == 1:
+        func = functools.partial(histogram_chunk, func, summary.max_value)
+    plan = plan_job(d4container, options)
+    region_index = chunk_regions(
+        d4container.task_regions, d4container.chunk_size
+    )
+    todo = list(range(plan.shape[0]))
+    for index, job, bounds, ring in run_jobs(
+        d4container, func, plan, todo, options
+    ):
+        if len(groups) == 1:
+            counts = bounds[0]
+        else:
+            with stage_timer(report, "reduce"):
+                data = reduce_job(ring, job, bounds)
+            counts = histogram(data[0], summary.max_value)
+        with stage_timer(report, "summary"):
+            summary.add(region_index[index], counts)
+    with stage_timer(report, "close"):
+        summary.close()
+    if report is not None:
+        report.write()
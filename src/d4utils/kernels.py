@@ -0,0 +1,445 @@
+"""Accumulation kernels for reducing d4 tracks.
+
+D4 stores values as int32, so chunk results are handed to the writer
+as int32. Accumulators pick the smallest dtype that can hold the
+reduction and update it in place, and any result that would not fit
+in the output width raises OverflowError instead of silently wrapping.
+
+"""
+
+import logging
+from typing import Any, Callable, Sequence, Union
+
+import numpy as np
+import numpy.typing as npt
+
+logger = logging.getLogger(__name__)
+
+INT32_MIN = int(np.iinfo(np.int32).min)
+INT32_MAX = int(np.iinfo(np.int32).max)
+
+
+def accumulator_dtype(
+    nsamples: int, max_value: int, *, signed: bool = True
+) -> np.dtype:
+    """Return smallest dtype that can hold nsamples x max_value.
+
+    >>> accumulator_dtype(300, 1, signed=False)
+    dtype('uint16')
+    >>> accumulator_dtype(3, 2**30)
+    dtype('int64')
+    """
+    bound = nsamples * max_value
+    if signed:
+        candidates = (np.int32, np.int64)
+    else:
+        candidates = (np.uint8, np.uint16, np.uint32, np.uint64)
+    for dtype in candidates:
+        if bound <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise OverflowError(f"no integer dtype can hold a bound of {bound}")
+
+
+def check_int32_range(data: npt.NDArray[Any]) -> None:
+    """Raise OverflowError if data does not fit the int32 d4 values."""
+    if data.size == 0 or data.dtype == np.int32:
+        return
+    if int(data.max()) > INT32_MAX or int(data.min()) < INT32_MIN:
+        raise OverflowError(
+            "reduced coverage exceeds the int32 range of the d4 format"
+        )
+
+
+def histogram(x: npt.NDArray[Any], max_value: int) -> npt.NDArray[np.int64]:
+    """Return counts of the values 0..max_value in x.
+
+    Values are clipped in place to [0, max_value], so values above
+    max_value are counted in the last bin. Trailing empty bins are
+    dropped.
+
+    >>> histogram(np.array([0, 2, 2, 9], dtype=np.int32), 5)
+    array([1, 0, 2, 0, 0, 1])
+    >>> histogram(np.array([0, 1, 1], dtype=np.int32), 5)
+    array([1, 2])
+    """
+    np.clip(x, 0, max_value, out=x)
+    counts = np.bincount(x, minlength=max_value + 1)
+    return np.trim_zeros(counts, "b")
+
+
+# Elements compared per step of `constant_value`, small enough to stay
+# in cache between the min and max reductions
+CONSTANT_BLOCK = 2**16
+
+
+def constant_value(x: npt.NDArray[Any]) -> Union[int, float, None]:
+    """Return the value of x if all its values are equal, else None.
+
+    The first, middle and last values are compared before the array is
+    scanned. The scan then goes block by block and stops at the first
+    block with another value, so a sparse track is usually rejected
+    after its first block, and a constant track is read once.
+
+    >>> constant_value(np.zeros(5, dtype=np.int32))
+    0
+    >>> constant_value(np.array([0, 1, 0], dtype=np.int32)) is None
+    True
+    """
+    n = x.shape[0]
+    if n == 0 or not x[0] == x[n // 2] == x[n - 1]:
+        return None
+    value = x[0]
+    for start in range(0, n, CONSTANT_BLOCK):
+        block = x[start : start + CONSTANT_BLOCK]
+        if block.min() != value or block.max() != value:
+            return None
+    return value.item()
+
+
+class SumAccumulator:
+    """Sum tracks into an int32 output buffer.
+
+    Values are added to an int64 accumulator, which holds the sum of
+    up to 2**32 int32 tracks exactly, so no per-sample range checks are
+    needed. The range of the sum is checked once, when the result is
+    written back to `out`, and gives the bound on its absolute value.
+    Float tracks, such as those of files with a denominator, are summed
+    in float64 and rounded once. Constant tracks, such as gaps, are
+    detected with `constant_value` and added as a scalar, or skipped if
+    zero. The accumulator can be preallocated by the caller so that it
+    is reused across chunks.
+
+    >>> acc = SumAccumulator(np.empty(2, dtype=np.int32))
+    >>> acc.add(np.array([0.4, 1.2]))
+    >>> acc.add(np.array([0.4, 1.2]))
+    >>> acc.result()
+    array([1, 2], dtype=int32)
+    """
+
+    def __init__(
+        self,
+        out: npt.NDArray[np.int32],
+        *,
+        acc: Union[npt.NDArray[np.int64], None] = None,
+    ):
+        """Initialize accumulator writing to output buffer."""
+        n = out.shape[0]
+        buf = np.empty(n, dtype=np.int64) if acc is None else acc
+        assert buf.dtype == np.int64, "accumulator must be int64"
+        self._out = out
+        self._acc: npt.NDArray[Any] = buf[:n]
+        self._acc.fill(0)
+        self._bound = 0
+
+    @property
+    def bound(self) -> int:
+        """Return bound on the absolute value of the sum.
+
+        The bound is known once the result has been computed.
+        """
+        return self._bound
+
+    def add(self, x: npt.NDArray[Any]) -> None:
+        """Add track values to the accumulator."""
+        if x.dtype.kind == "f" and self._acc.dtype.kind != "f":
+            logger.debug("Widening sum accumulator to float64")
+            self._acc = self._acc.astype(np.float64)
+        value = constant_value(x)
+        if value is not None:
+            if value != 0:
+                self._acc += value
+            return
+        np.add(self._acc, x, out=self._acc, casting="unsafe")
+
+    def result(self) -> npt.NDArray[np.int32]:
+        """Return the sum in the output buffer."""
+        if self._acc.dtype.kind == "f":
+            np.rint(self._acc, out=self._acc)
+        if self._acc.size > 0:
+            high, low = int(self._acc.max()), int(self._acc.min())
+            if high > INT32_MAX or low < INT32_MIN:
+                raise OverflowError(
+                    "reduced coverage exceeds the int32 range of the d4 format"
+                )
+            self._bound = max(high, -low, 0)
+        self._out[:] = self._acc
+        return self._out
+
+
+def count_in_range(
+    acc: npt.NDArray[Any],
+    x: npt.NDArray[Any],
+    min_coverage: Union[int, float],
+    max_coverage: Union[int, float],
+    mask: npt.NDArray[np.bool_],
+) -> None:
+    """Add one to acc where min_coverage <= x <= max_coverage.
+
+    The update is done in place using the preallocated boolean `mask`
+    as the only scratch space. For int32 input, the two comparisons are
+    fused into a single unsigned comparison of `x - min_coverage`
+    against the width of the range, which is computed in place in `x`;
+    x is therefore clobbered.
+
+    >>> acc = np.zeros(5, dtype=np.uint8)
+    >>> mask = np.empty(5, dtype=bool)
+    >>> x = np.array([0, 1, 2, 3, -1], dtype=np.int32)
+    >>> count_in_range(acc, x, 1, 2, mask)
+    >>> acc
+    array([0, 1, 1, 0, 0], dtype=uint8)
+    """
+    mask = mask[: x.shape[0]]
+    if x.dtype == np.int32:
+        low = max(min_coverage, INT32_MIN)
+        high = min(max_coverage, INT32_MAX)
+        if low > high:
+            return
+        low, high = int(np.ceil(low)), int(high)
+        if low > high:
+            return
+        np.subtract(x, np.int32(low), out=x)
+        np.less_equal(x.view(np.uint32), np.uint32(high - low), out=mask)
+    else:
+        np.greater_equal(x, min_coverage, out=mask)
+        np.less_equal(x, max_coverage, out=mask, where=mask)
+    np.add(acc, mask, out=acc)
+
+
+class CountAccumulator:
+    """Count tracks with values in [min_coverage, max_coverage].
+
+    Counts are accumulated in the smallest unsigned dtype that can hold
+    `nsamples` and copied to the int32 output buffer at the end. The
+    accumulator and mask buffers can be preallocated by the caller so
+    that they are reused across chunks; buffers longer than the output
+    are truncated. Constant tracks, such as gaps, are detected with
+    `constant_value` and counted without a mask.
+    """
+
+    def __init__(
+        self,
+        out: npt.NDArray[np.int32],
+        nsamples: int,
+        min_coverage: int,
+        max_coverage: Union[int, float],
+        *,
+        acc: Union[npt.NDArray[Any], None] = None,
+        mask: Union[npt.NDArray[np.bool_], None] = None,
+    ):
+        """Initialize accumulator for nsamples tracks."""
+        n = out.shape[0]
+        dtype = accumulator_dtype(nsamples, 1, signed=False)
+        acc_buf = np.empty(n, dtype=dtype) if acc is None else acc
+        assert acc_buf.dtype == dtype, f"accumulator must be {dtype}"
+        mask_buf = np.empty(n, dtype=np.bool_) if mask is None else mask
+        self._out = out
+        self._acc = acc_buf[:n]
+        self._acc.fill(0)
+        self._mask = mask_buf[:n]
+        self._nsamples = nsamples
+        self._added = 0
+        self._min_coverage = min_coverage
+        self._max_coverage = max_coverage
+
+    @property
+    def bound(self) -> int:
+        """Return bound on the count."""
+        return self._nsamples
+
+    def add(self, x: npt.NDArray[Any]) -> None:
+        """Add one to positions whose values are within range.
+
+        Values in x may be overwritten.
+        """
+        self._added += 1
+        if self._added > self._nsamples:
+            raise OverflowError(
+                f"count accumulator sized for {self._nsamples} samples"
+            )
+        value = constant_value(x)
+        if value is not None:
+            if self._min_coverage <= value <= self._max_coverage:
+                self._acc += 1
+            return
+        count_in_range(
+            self._acc, x, self._min_coverage, self._max_coverage, self._mask
+        )
+
+    def add_counts(self, x: npt.NDArray[Any]) -> None:
+        """Add precomputed counts, such as those of a previous track.
+
+        The accumulator must be sized for the largest count in x.
+        """
+        np.add(self._acc, x, out=self._acc, casting="unsafe")
+
+    def result(self) -> npt.NDArray[np.int32]:
+        """Return the counts in the output buffer."""
+        self._out[:] = self._acc
+        return self._out
+
+
+# Statistics computed across samples by StatsAccumulator
+STATISTICS = ("sum", "mean", "min", "max", "var")
+
+
+class StatsAccumulator:
+    """Compute several statistics across tracks in a single pass.
+
+    Every added track updates running sums, sums of squares, extrema
+    and per-bin counts as needed by the requested `statistics` and
+    coverage `bins`, given as (min_coverage, max_coverage) tuples.
+    Sums are kept in float64, which is exact for int32 values summed
+    over fewer than 2**22 samples. Mean and variance (population
+    variance across samples) are multiplied by `scale` and rounded, as
+    d4 stores int32 values.
+
+    Buffers are obtained from `alloc(key, dtype)`, which defaults to
+    allocating new arrays of the track length.
+    """
+
+    def __init__(
+        self,
+        n: int,
+        nsamples: int,
+        statistics: Sequence[str],
+        bins: Sequence[tuple[Union[int, float], Union[int, float]]] = (),
+        *,
+        scale: float = 1.0,
+        alloc: Union[Callable[[str, Any], npt.NDArray[Any]], None] = None,
+    ):
+        """Initialize accumulator for nsamples tracks of length n."""
+
+        def allocate(key: str, dtype: Any) -> npt.NDArray[Any]:
+            if alloc is None:
+                return np.empty(n, dtype=dtype)
+            return alloc(key, dtype)[:n]
+
+        self._statistics = list(statistics)
+        self._bins = list(bins)
+        self._nsamples = nsamples
+        self._scale = scale
+        self._added = 0
+        stats = set(self._statistics)
+        self._s1 = self._s2 = self._sq = self._min = self._max = None
+        if stats & {"sum", "mean", "var"}:
+            self._s1 = allocate("s1", np.float64)
+            self._s1.fill(0)
+        if "var" in stats:
+            self._s2 = allocate("s2", np.float64)
+            self._s2.fill(0)
+            # Scratch space for the squares of a track
+            self._sq = allocate("sq", np.float64)
+        if "min" in stats:
+            self._min = allocate("min", np.float64)
+            self._min.fill(np.inf)
+        if "max" in stats:
+            self._max = allocate("max", np.float64)
+            self._max.fill(-np.inf)
+        dtype = accumulator_dtype(nsamples, 1, signed=False)
+        self._counts = [
+            allocate(f"count{i}", dtype) for i in range(len(self._bins))
+        ]
+        for acc in self._counts:
+            acc.fill(0)
+        if self._bins:
+            self._mask = allocate("mask", np.bool_)
+            self._tmp = allocate("tmp", np.int32)
+
+    @property
+    def names(self) -> list[str]:
+        """Return names of the output tracks."""
+        return track_names(self._statistics, self._bins)
+
+    def add(self, x: npt.NDArray[Any]) -> None:
+        """Add track values to the accumulator."""
+        self._added += 1
+        if self._added > self._nsamples:
+            raise OverflowError(
+                f"stats accumulator sized for {self._nsamples} samples"
+            )
+        if self._s1 is not None:
+            np.add(self._s1, x, out=self._s1)
+        if self._s2 is not None and self._sq is not None:
+            np.square(x, out=self._sq, dtype=np.float64)
+            np.add(self._s2, self._sq, out=self._s2)
+        if self._min is not None:
+            np.minimum(self._min, x, out=self._min)
+        if self._max is not None:
+            np.maximum(self._max, x, out=self._max)
+        for acc, (low, high) in zip(self._counts, self._bins):
+            tmp = x
+            if x.dtype == np.int32:
+                # count_in_range clobbers int32 input
+                tmp = self._tmp
+                np.copyto(tmp, x)
+            count_in_range(acc, tmp, low, high, self._mask)
+
+    def result(self, out: npt.NDArray[np.int32]) -> npt.NDArray[np.int32]:
+        """Write one int32 track per output name to the rows of out."""
+        nsamples = max(self._added, 1)
+        s1, s2 = self._s1, self._s2
+        for row, name in zip(out, self._statistics):
+            if name == "sum":
+                value = s1
+            elif name == "mean":
+                assert s1 is not None
+                value = s1 * (self._scale / nsamples)
+            elif name == "var":
+                assert s1 is not None and s2 is not None
+                mean = s1 / nsamples
+                value = s2 / nsamples - np.square(mean)
+                np.maximum(value, 0, out=value)
+                value *= self._scale
+            elif name == "min":
+                value = self._min
+            else:
+                value = self._max
+            assert value is not None, f"{name} was not accumulated"
+            value = np.rint(value)
+            check_int32_range(value)
+            row[:] = value
+        for row, acc in zip(out[len(self._statistics) :], self._counts):
+            row[:] = acc
+        return out
+
+
+def track_names(
+    statistics: Sequence[str],
+    bins: Sequence[tuple[Union[int, float], Union[int, float]]] = (),
+) -> list[str]:
+    """Return output track names for statistics and coverage bins.
+
+    >>> track_names(["sum", "mean"], [(1, 10), (11, np.inf)])
+    ['sum', 'mean', 'count_1_10', 'count_11_inf']
+    """
+    return list(statistics) + [f"count_{low:g}_{high:g}" for low, high in bins]
+
+
+def stats_bytes_per_base(
+    nsamples: int,
+    statistics: Sequence[str],
+    bins: Sequence[tuple[Union[int, float], Union[int, float]]] = (),
+) -> int:
+    """Return StatsAccumulator scratch memory per base of a chunk.
+
+    Counts the float64 sums, squares and extrema, the per-bin counts
+    with their mask and copy buffers, and the float64 temporaries of
+    `StatsAccumulator.result`.
+
+    >>> stats_bytes_per_base(10, STATISTICS, [(1, 10)])
+    70
+    """
+    stats = set(statistics)
+    nbytes = 0
+    if stats & {"sum", "mean", "var"}:
+        nbytes += 8
+    if "var" in stats:
+        nbytes += 16
+    nbytes += 8 * len(stats & {"min", "max"})
+    if bins:
+        dtype = accumulator_dtype(nsamples, 1, signed=False)
+        nbytes += len(bins) * dtype.itemsize + 1 + 4
+    if stats:
+        # result rounds into a new array, and var also holds the mean
+        nbytes += 24 if "var" in stats else 8
+    return nbytes
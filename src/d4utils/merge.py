@@ -0,0 +1,66 @@
+# type: ignore
+"""Merge shard outputs.
+
+Stitch the partial d4 files written by sum or count with --shard into
+a single-track d4 file. Every shard's regions are copied from its
+partial output in genome order; nothing is recomputed. The track info
+recorded in the shard manifests is written for the merged track, so
+that it can be updated with --update.
+
+"""
+
+import logging
+import pathlib
+from typing import Union
+
+import click
+import numpy as np
+import pyd4
+
+from d4utils.arguments import outfile
+from d4utils.engine import MAX_CHUNK_SIZE
+from d4utils.options import chunk_size_option
+from d4utils.options import verbose_option as verbose
+from d4utils.shard import read_shard_manifests
+from d4utils.update import save_track_info
+from d4utils.worker import CachedD4File
+
+logger = logging.getLogger(__name__)
+
+
+@click.command(help=__doc__)
+@verbose()
+@click.argument("path", nargs=-1, type=click.Path(exists=True))
+@outfile()
+@chunk_size_option()
+def merge(
+    path: list[pathlib.Path],
+    outfile: pathlib.Path,
+    chunk_size: Union[int, None],
+) -> None:
+    """Merge shards."""
+    manifests = read_shard_manifests(path)
+    if chunk_size is None:
+        chunk_size = MAX_CHUNK_SIZE
+    chroms = [tuple(x) for x in manifests[0]["chroms"]]
+    writer = pyd4.D4Builder(str(outfile)).add_chroms(chroms).get_writer()
+    buffer = np.empty(chunk_size, dtype=np.int32)
+    for manifest in manifests:
+        logger.info(
+            "Copying shard %i/%i from %s",
+            manifest["index"],
+            manifest["count"],
+            manifest["path"],
+        )
+        handle = CachedD4File(manifest["path"])
+        for chrom_name, begin, end in manifest["regions"]:
+            for b in range(begin, end, chunk_size):
+                e = min(b + chunk_size, end)
+                data = handle.load(chrom_name, b, e, out=buffer[: e - b])
+                writer.write_np_array(chrom_name, b, data)
+    writer.close()
+    info = manifests[0].get("track")
+    if info is None:
+        logger.warning("Shard manifests have no track info for %s", outfile)
+    else:
+        save_track_info(outfile, info)
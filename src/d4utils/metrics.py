@@ -0,0 +1,225 @@
+"""Per-stage timers and counters for profiling jobs.
+
+Profiling is off unless a job is given a JobReport. Tasks are then run
+through `profiled`, which enables timers and counters in the worker,
+and returns the worker's metrics for the task along with the result.
+The parent merges them with its own timers, for waiting on the queue,
+reducing and writing, and writes an aggregated JSON report, optionally
+with periodic progress snapshots.
+
+Worker stages are `open` (opening d4 files), `decode` (decoding
+values), `decode_wait` (waiting for a prefetched sample),
+`accumulate` (reducing a sample) and `task` (a whole task). Parent
+stages are `submit_wait` (waiting for a free queue slot),
+`result_wait` (waiting for the head of the window), `reduce`,
+`write`, `checkpoint`, `summary` and `close`, and the parent counts
+chunk tracks skipped because they are zero throughout as
+`empty_tracks`.
+
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Iterator, Union
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Thread-safe timers and counters of one process."""
+
+    def __init__(self) -> None:
+        """Initialize empty metrics."""
+        self._timers: dict[str, float] = {}
+        self._counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Add seconds to the timer of stage `name`."""
+        with self._lock:
+            self._timers[name] = self._timers.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Add value to counter `name`."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def merge(self, metrics: dict[str, dict[str, Any]]) -> None:
+        """Add timers and counters from a dictionary made by as_dict."""
+        for name, seconds in metrics["timers"].items():
+            self.add_time(name, seconds)
+        for name, value in metrics["counters"].items():
+            self.count(name, value)
+
+    def as_dict(self) -> dict[str, dict[str, Any]]:
+        """Return timers and counters as a dictionary."""
+        with self._lock:
+            return {
+                "timers": dict(self._timers),
+                "counters": dict(self._counters),
+            }
+
+    def reset(self) -> None:
+        """Clear timers and counters."""
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+
+
+# Metrics of the current worker thread, set while a profiled task runs
+_local = threading.local()
+
+
+def current() -> Union[Metrics, None]:
+    """Return metrics of the current worker thread, if profiling."""
+    return getattr(_local, "metrics", None)
+
+
+@contextlib.contextmanager
+def recording(metrics: Union[Metrics, None]) -> Iterator[None]:
+    """Record worker timers and counters of the enclosed block."""
+    previous = current()
+    _local.metrics = metrics
+    try:
+        yield
+    finally:
+        _local.metrics = previous
+
+
+def timer(name: str) -> ContextManager[None]:
+    """Time a worker stage if profiling is enabled."""
+    metrics = current()
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.timer(name)
+
+
+def add_time(name: str, seconds: float) -> None:
+    """Add seconds to a worker stage if profiling is enabled."""
+    metrics = current()
+    if metrics is not None:
+        metrics.add_time(name, seconds)
+
+
+def count(name: str, value: int = 1) -> None:
+    """Add to a worker counter if profiling is enabled."""
+    metrics = current()
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+def profiled(
+    func: Callable[[Any], Any], task: Any
+) -> tuple[Any, int, dict[str, dict[str, Any]]]:
+    """Run func on a task with profiling enabled.
+
+    Returns the result, the process id and the metrics of the task.
+    Tasks are profiled per thread, so that thread workers do not mix
+    their metrics.
+    """
+    metrics = Metrics()
+    with recording(metrics), metrics.timer("task"):
+        result = func(task)
+    return result, os.getpid(), metrics.as_dict()
+
+
+class JobReport:
+    """Aggregated metrics of a job.
+
+    If `path` is given, the report is written there as JSON when the
+    job is closed and, every `interval` seconds, while it runs.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path, None] = None,
+        interval: Union[float, None] = None,
+    ):
+        """Initialize report."""
+        self._path = path
+        self._interval = interval
+        self.parent = Metrics()
+        self.workers = Metrics()
+        self._busy: dict[int, float] = {}
+        self._snapshots: list[dict[str, Any]] = []
+        self._config: dict[str, Any] = {}
+        self._start = time.perf_counter()
+        self._last = self._start
+        self._chunks = self._bases = self._nchunks = 0
+
+    def start(self, **config: Any) -> None:
+        """Start timing a job and record its configuration."""
+        self._config = config
+        self._nchunks = config.get("chunks", 0)
+        self._start = self._last = time.perf_counter()
+
+    def add_task(self, result: tuple[Any, int, dict[str, Any]]) -> Any:
+        """Add worker metrics of a profiled task and return its result."""
+        value, pid, metrics = result
+        self.workers.merge(metrics)
+        busy = metrics["timers"].get("task", 0.0)
+        self._busy[pid] = self._busy.get(pid, 0.0) + busy
+        return value
+
+    def add_chunk(self, bases: int) -> None:
+        """Record a finished chunk and take a snapshot if one is due."""
+        self._chunks += 1
+        self._bases += bases
+        now = time.perf_counter()
+        if self._interval is not None and now - self._last >= self._interval:
+            self._last = now
+            snapshot = self._progress(now)
+            self._snapshots.append(snapshot)
+            logger.info("Progress: %s", snapshot)
+            self.write(status="running")
+
+    def _progress(self, now: float) -> dict[str, Any]:
+        elapsed = now - self._start
+        return {
+            "elapsed": elapsed,
+            "chunks": self._chunks,
+            "chunks_total": self._nchunks,
+            "bases": self._bases,
+            "chunks_per_s": self._chunks / elapsed if elapsed else None,
+        }
+
+    def report(self, status: str = "done") -> dict[str, Any]:
+        """Return the report as a dictionary."""
+        now = time.perf_counter()
+        progress = self._progress(now)
+        wall = progress.pop("elapsed")
+        busy = sum(self._busy.values())
+        workers = self._config.get("cores", 1)
+        return {
+            "status": status,
+            "config": self._config,
+            "wall_time": wall,
+            **progress,
+            "bases_per_s": self._bases / wall if wall else None,
+            "parent": self.parent.as_dict(),
+            "workers": self.workers.as_dict(),
+            "worker_busy_time": {str(k): v for k, v in self._busy.items()},
+            "worker_idle_time": max(workers * wall - busy, 0.0),
+            "snapshots": self._snapshots,
+        }
+
+    def write(self, status: str = "done") -> None:
+        """Write the report to path, if one was given."""
+        if self._path is None:
+            return
+        with open(self._path, "w", encoding="utf-8") as fh:
+            json.dump(self.report(status), fh, indent=2)
@@ -6,10 +6,10 @@ from typing import Callable, Union
 
 import click
 import numpy as np
-import pandas as pd
 from click.decorators import FC
 
-from d4utils.d4 import parse_region
+from d4utils.d4 import Region, parse_region, read_bed
+from d4utils.kernels import STATISTICS
 
 
 def verbose_option(expose_value: bool = False) -> Callable[[FC], FC]:
@@ -59,44 +59,432 @@ def cores_option() -> Callable[[FC], FC]:
     )
 
 
+def parse_size(value: str) -> int:
+    """Parse size with optional K, M, G or T suffix to bytes.
+
+    >>> parse_size("512M")
+    536870912
+    >>> parse_size("1000")
+    1000
+    """
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    value = value.strip().upper().removesuffix("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
 def chunk_size_option() -> Callable[[FC], FC]:
     """Add chunk size option."""
 
     def chunk_size_callback(
+        ctx: click.core.Context, param: click.core.Option, value: str
+    ) -> Union[int, None]:  # pylint: disable=unused-argument
+        """Chunk size callback.
+
+        Returns None for auto, in which case the chunk size is planned
+        from the job size and memory budget.
+        """
+        if value == "auto":
+            return None
+        try:
+            size = int(value)
+        except ValueError as e:
+            raise click.BadParameter("must be an integer or 'auto'") from e
+        if size < 1:
+            logging.error("Chunk size must be greater than 0")
+            raise ValueError("Chunk size must be greater than 0")
+        return size
+
+    return click.option(
+        "--chunk-size",
+        help=(
+            "region chunk size, or auto to plan it from the number of "
+            "samples, cores and memory budget"
+        ),
+        default="1000000",
+        show_default=True,
+        callback=chunk_size_callback,
+    )
+
+
+def memory_budget_option() -> Callable[[FC], FC]:
+    """Add memory budget option."""
+
+    def memory_budget_callback(
+        ctx: click.core.Context,
+        param: click.core.Option,
+        value: Union[str, None],
+    ) -> Union[int, None]:  # pylint: disable=unused-argument
+        """Memory budget callback."""
+        if value is None:
+            return None
+        try:
+            size = parse_size(value)
+        except ValueError as e:
+            raise click.BadParameter("must be a size such as 4G") from e
+        if size < 1:
+            logging.error("Memory budget must be greater than 0")
+            raise ValueError("Memory budget must be greater than 0")
+        return size
+
+    return click.option(
+        "--memory-budget",
+        help=(
+            "memory budget for chunk buffers, e.g. 4G; limits the chunk "
+            "size chosen by --chunk-size auto"
+        ),
+        callback=memory_budget_callback,
+    )
+
+
+def engine_option() -> Callable[[FC], FC]:
+    """Add reduction engine option."""
+    return click.option(
+        "--engine",
+        help=(
+            "reduce dense per-base arrays or runs of constant values; "
+            "runs is experimental and uses more memory without being "
+            "faster, as samples are still decoded densely"
+        ),
+        type=click.Choice(["dense", "runs"]),
+        default="dense",
+        show_default=True,
+    )
+
+
+def executor_option() -> Callable[[FC], FC]:
+    """Add executor option."""
+    return click.option(
+        "--executor",
+        help=(
+            "run chunks on a process pool, a thread pool or serially in "
+            "the main process; auto chooses from the job size"
+        ),
+        type=click.Choice(["serial", "thread", "process", "auto"]),
+        default="auto",
+        show_default=True,
+    )
+
+
+def window_size_option() -> Callable[[FC], FC]:
+    """Add window size option."""
+
+    def window_size_callback(
+        ctx: click.core.Context,
+        param: click.core.Option,
+        value: Union[int, None],
+    ) -> Union[int, None]:  # pylint: disable=unused-argument
+        """Window size callback."""
+        if value is not None and value < 1:
+            logging.error("Window size must be greater than 0")
+            raise ValueError("Window size must be greater than 0")
+        return value
+
+    return click.option(
+        "--window-size",
+        help=(
+            "max number of chunks in flight; peak result memory is "
+            "about window size x chunk size [default: 4 x cores]"
+        ),
+        type=int,
+        callback=window_size_callback,
+    )
+
+
+def sample_groups_option() -> Callable[[FC], FC]:
+    """Add sample groups option."""
+
+    def sample_groups_callback(
         ctx: click.core.Context, param: click.core.Option, value: int
     ) -> int:  # pylint: disable=unused-argument
-        """Chunk size callback."""
+        """Sample groups callback."""
         if value < 1:
-            logging.error("Chunk size must be greater than 0")
-            raise ValueError("Chunk size must be greater than 0")
+            logging.error("Sample groups must be greater than 0")
+            raise ValueError("Sample groups must be greater than 0")
+        return value
+
+    return click.option(
+        "--sample-groups",
+        help=(
+            "split samples into this many groups processed by separate "
+            "workers for each chunk"
+        ),
+        default=1,
+        type=int,
+        callback=sample_groups_callback,
+    )
+
+
+def checkpoint_option() -> Callable[[FC], FC]:
+    """Add checkpoint option."""
+    return click.option(
+        "--checkpoint",
+        help=(
+            "stage finished chunks in OUTFILE.checkpoint so that an "
+            "interrupted job can be resumed with --resume"
+        ),
+        is_flag=True,
+        default=False,
+    )
+
+
+def resume_option() -> Callable[[FC], FC]:
+    """Add resume option.
+
+    The option is eager so that the outfile callback can allow the
+    partial output of the interrupted job.
+    """
+    return click.option(
+        "--resume",
+        help=(
+            "resume an interrupted job from OUTFILE.checkpoint, skipping "
+            "finished chunks; implies --checkpoint"
+        ),
+        is_flag=True,
+        default=False,
+        is_eager=True,
+    )
+
+
+def shard_option() -> Callable[[FC], FC]:
+    """Add shard option."""
+
+    def shard_callback(
+        ctx: click.core.Context,
+        param: click.core.Option,
+        value: Union[str, None],
+    ) -> Union[tuple[int, int], None]:  # pylint: disable=unused-argument
+        """Shard callback.
+
+        Parses I/N to (I, N), where shards are numbered from 1.
+        """
+        if value is None:
+            return None
+        try:
+            index, count = (int(x) for x in value.split("/"))
+        except ValueError as e:
+            raise click.BadParameter("must be of the form I/N") from e
+        if not 1 <= index <= count:
+            logging.error("Shard index must be between 1 and shard count")
+            raise ValueError("Shard index must be between 1 and shard count")
+        return index, count
+
+    return click.option(
+        "--shard",
+        help=(
+            "process only shard I/N of the regions and write a partial "
+            "output to combine with d4utils merge"
+        ),
+        metavar="I/N",
+        callback=shard_callback,
+    )
+
+
+def statistic_option() -> Callable[[FC], FC]:
+    """Add statistic option."""
+    return click.option(
+        "--statistic",
+        "-s",
+        "statistics",
+        help="statistic across samples; repeat for several [default: all]",
+        type=click.Choice(STATISTICS),
+        multiple=True,
+    )
+
+
+def bin_option() -> Callable[[FC], FC]:
+    """Add coverage bin option."""
+
+    def bin_callback(
+        ctx: click.core.Context,
+        param: click.core.Option,
+        value: list[str],
+    ) -> list[tuple[int, Union[int, float]]]:  # pylint: disable=unused-argument
+        """Bin callback.
+
+        Parses MIN:MAX to (MIN, MAX), where an empty MAX is unbounded.
+        """
+        bins = []
+        for x in value:
+            try:
+                low, high = x.split(":")
+                bins.append((int(low), int(high) if high else np.inf))
+            except ValueError as e:
+                raise click.BadParameter("must be of the form MIN:MAX") from e
+        return bins
+
+    return click.option(
+        "--bin",
+        "bins",
+        help=(
+            "count samples with coverage in MIN:MAX, inclusive; an empty "
+            "MAX is unbounded; repeat for several bins"
+        ),
+        metavar="MIN:MAX",
+        multiple=True,
+        callback=bin_callback,
+    )
+
+
+def scale_option() -> Callable[[FC], FC]:
+    """Add scale option."""
+    return click.option(
+        "--scale",
+        help="multiply mean and variance by scale before rounding to int",
+        default=1.0,
+        type=float,
+        show_default=True,
+    )
+
+
+def summary_option() -> Callable[[FC], FC]:
+    """Add summary option."""
+    return click.option(
+        "--summary",
+        help=(
+            "write per-region and genome-wide histograms of the result, "
+            "in bedtools coverage -hist format, to OUTFILE instead of a "
+            "per-base d4 track"
+        ),
+        is_flag=True,
+        default=False,
+    )
+
+
+def histogram_max_option(default: str) -> Callable[[FC], FC]:
+    """Add histogram max option."""
+
+    def histogram_max_callback(
+        ctx: click.core.Context,
+        param: click.core.Option,
+        value: Union[int, None],
+    ) -> Union[int, None]:  # pylint: disable=unused-argument
+        """Histogram max callback."""
+        if value is not None and value < 1:
+            logging.error("Histogram max must be greater than 0")
+            raise ValueError("Histogram max must be greater than 0")
         return value
 
     return click.option(
-        "--chunk-size", help="region chunk size", default=1000000, type=int
+        "--histogram-max",
+        help=(
+            "largest value with its own histogram bin in summaries; "
+            f"larger values are counted in it [default: {default}]"
+        ),
+        type=int,
+        callback=histogram_max_callback,
+    )
+
+
+def prefetch_option() -> Callable[[FC], FC]:
+    """Add prefetch option."""
+
+    def prefetch_callback(
+        ctx: click.core.Context, param: click.core.Option, value: int
+    ) -> int:  # pylint: disable=unused-argument
+        """Prefetch callback."""
+        if value < 0:
+            logging.error("Prefetch must be 0 or greater")
+            raise ValueError("Prefetch must be 0 or greater")
+        return value
+
+    return click.option(
+        "--prefetch",
+        help=(
+            "number of files each worker decodes ahead of the one being "
+            "accumulated; 0 disables prefetching"
+        ),
+        default=1,
+        type=int,
+        show_default=True,
+        callback=prefetch_callback,
+    )
+
+
+def write_batch_option() -> Callable[[FC], FC]:
+    """Add write batch option."""
+
+    def write_batch_callback(
+        ctx: click.core.Context,
+        param: click.core.Option,
+        value: Union[int, None],
+    ) -> Union[int, None]:  # pylint: disable=unused-argument
+        """Write batch callback."""
+        if value is not None and value < 0:
+            logging.error("Write batch must be 0 or greater")
+            raise ValueError("Write batch must be 0 or greater")
+        return value
+
+    return click.option(
+        "--write-batch",
+        help=(
+            "number of bases of consecutive chunks written at once, so "
+            "that the output is encoded in parallel; 0 writes every chunk "
+            "directly [default: 1000000 x cores]"
+        ),
+        type=int,
+        callback=write_batch_callback,
+    )
+
+
+def profile_option() -> Callable[[FC], FC]:
+    """Add profile option."""
+    return click.option(
+        "--profile",
+        help="print a JSON report of per-stage timers and counters",
+        is_flag=True,
+        default=False,
+    )
+
+
+def metrics_out_option() -> Callable[[FC], FC]:
+    """Add metrics out option."""
+    return click.option(
+        "--metrics-out",
+        help="write a JSON report of per-stage timers and counters",
+        type=click.Path(),
+    )
+
+
+def metrics_interval_option() -> Callable[[FC], FC]:
+    """Add metrics interval option."""
+    return click.option(
+        "--metrics-interval",
+        help=(
+            "seconds between progress snapshots added to the metrics "
+            "report, which is rewritten at each snapshot"
+        ),
+        type=float,
+    )
+
+
+def update_option() -> Callable[[FC], FC]:
+    """Add update option."""
+    return click.option(
+        "--update",
+        help=(
+            "add the new samples to an existing track made by the same "
+            "command, reading it instead of the previous samples"
+        ),
+        type=click.Path(exists=True),
     )
 
 
 def regions_option() -> Callable[[FC], FC]:
-    """Add regions option and parse arguments to a pandas DataFrame."""
+    """Add regions option and parse arguments to a list of regions."""
 
     def regions_callback(
         ctx: click.core.Context,
         param: click.core.Option,
         value: Union[str, None],
-    ) -> pd.DataFrame | None:
+    ) -> Union[list[Region], None]:
         """Regions callback."""
         if value is None:
             return None
         if os.path.isfile(value):
-            return pd.read_table(
-                value,
-                names=["chrom", "begin", "end"],
-                usecols=[0, 1, 2],
-                header=None,
-            )
-
-        chrom, begin, end = parse_region(value)
-        return pd.DataFrame({"chrom": [chrom], "begin": [begin], "end": [end]})
+            return read_bed(value)
+        return [parse_region(value)]
 
     return click.option(
         "-R",
@@ -1,10 +1,58 @@
 """This module provides a functionality to initilize and maintain a
-MaxQueuePool."""
+MaxQueuePool.
+
+The pool can run tasks on a process pool, a thread pool or serially in
+the calling thread; see `EXECUTORS`.
+
+"""
 
 import concurrent.futures
+import contextlib
 import logging
+from collections import deque
 from threading import BoundedSemaphore
-from typing import Any, Callable, Union
+from typing import Any, Callable, Iterable, Iterator, Sequence, Union
+
+from d4utils.metrics import Metrics
+
+# Execution backends of init_pool; "auto" is resolved by the caller
+EXECUTORS = ("serial", "thread", "process", "auto")
+
+
+class SerialExecutor(concurrent.futures.Executor):
+    """Executor that runs tasks in the calling thread.
+
+    Tasks run when they are submitted and return completed futures,
+    so there is no pool, pickling or inter-process communication. The
+    initializer is called once, in the calling thread.
+    """
+
+    def __init__(
+        self,
+        max_workers: Union[int, None] = None,
+        initializer: Union[Callable[..., Any], None] = None,
+        initargs: tuple[Any, ...] = (),
+    ):
+        """Initialize executor, calling the initializer.
+
+        `max_workers` is accepted for compatibility and ignored.
+        """
+        del max_workers
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(
+        self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any
+    ) -> concurrent.futures.Future:
+        """Run fn and return a completed future with its outcome."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:  # pylint: disable=broad-except
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
 
 
 class MaxQueuePool:
@@ -22,18 +70,23 @@ class MaxQueuePool:
 
     def __init__(
         self,
-        executor: type[concurrent.futures.ProcessPoolExecutor],
+        executor: Callable[..., concurrent.futures.Executor],
         *,
         max_queue_size: int,
         max_workers: Union[int, Any] = None,
+        **kwargs: Any,
     ):
-        """Initialize the pool with a maximum number of workers."""
+        """Initialize the pool with a maximum number of workers.
+
+        Additional keyword arguments, such as `initializer` and
+        `initargs`, are passed on to the executor.
+        """
         logging.info(
             "Initializing queue with %i queue slots, %i workers",
             max_queue_size,
             max_workers,
         )
-        self.pool = executor(max_workers=max_workers)
+        self.pool = executor(max_workers=max_workers, **kwargs)
         self.pool_queue = BoundedSemaphore(max_queue_size)
 
     def submit(
@@ -53,11 +106,81 @@ class MaxQueuePool:
         """Called when a future is done. Releases one queue slot."""
         self.pool_queue.release()
 
+    def shutdown(self, wait: bool = True) -> None:
+        """Shut down the underlying executor."""
+        self.pool.shutdown(wait=wait)
 
-def init_pool(cores: int = 1) -> MaxQueuePool:
-    """Initialize a process pool with a maximum number of workers."""
+
+def init_pool(
+    cores: int = 1,
+    *,
+    executor: str = "process",
+    initializer: Union[Callable[..., Any], None] = None,
+    initargs: tuple[Any, ...] = (),
+) -> MaxQueuePool:
+    """Initialize a pool with a maximum number of workers.
+
+    `executor` is one of "process", "thread" or "serial". `initializer`
+    is called with `initargs` once in every worker process or thread
+    when it starts, or once in the calling thread for a serial pool.
+    """
+    executors: dict[str, Callable[..., concurrent.futures.Executor]] = {
+        "process": concurrent.futures.ProcessPoolExecutor,
+        "thread": concurrent.futures.ThreadPoolExecutor,
+        "serial": SerialExecutor,
+    }
+    if executor not in executors:
+        raise ValueError(f"unknown executor {executor}")
+    if executor == "serial":
+        cores = 1
     return MaxQueuePool(
-        concurrent.futures.ProcessPoolExecutor,
+        executors[executor],
         max_workers=cores,
         max_queue_size=int(2 * cores),
+        initializer=initializer,
+        initargs=initargs,
     )
+
+
+def stream_ordered(
+    pool: MaxQueuePool,
+    func: Callable[[Any], Any],
+    jobs: Iterable[Sequence[Any]],
+    window: int,
+    metrics: Union[Metrics, None] = None,
+) -> Iterator[tuple[Sequence[Any], list[Any]]]:
+    """Submit jobs and yield (job, results) pairs in submission order.
+
+    A job is a sequence of tasks that are submitted together and whose
+    results are yielded together once all of them have completed. At
+    most `window` jobs are in flight or waiting to be consumed at any
+    time; a new job is only submitted once the consumer has resumed
+    the generator after the head of the window was yielded. Results
+    are therefore held for at most `window` jobs, regardless of the
+    total number of jobs.
+
+    If `metrics` is given, time spent waiting for a free queue slot
+    and for the results at the head of the window is recorded as
+    `submit_wait` and `result_wait`.
+    """
+
+    def timer(name: str) -> Any:
+        if metrics is None:
+            return contextlib.nullcontext()
+        return metrics.timer(name)
+
+    def results(futures: list[Any]) -> list[Any]:
+        with timer("result_wait"):
+            return [future.result() for future in futures]
+
+    pending: deque = deque()
+    for job in jobs:
+        if len(pending) >= window:
+            head, futures = pending.popleft()
+            yield head, results(futures)
+        with timer("submit_wait"):
+            futures = [pool.submit(func, task) for task in job]
+        pending.append((job, futures))
+    while pending:
+        head, futures = pending.popleft()
+        yield head, results(futures)
@@ -0,0 +1,176 @@
+"""Run-length representation of coverage tracks.
+
+Coverage tracks mostly consist of long runs of constant values. This
+module converts tracks to (starts, values) runs and reduces runs from
+many samples with a sweep line, where every run boundary is an event
+that changes the running value by the difference to the previous run.
+The reduction only touches run boundaries, so its cost scales with
+the number of runs rather than the number of bases.
+
+pyd4 does not expose the run structure of a d4 file, so each sample is
+still decoded into a dense, reusable buffer before it is converted to
+runs, and the sweep line needs an int64 difference array of chunk
+length. The runs engine is therefore experimental: it uses more memory
+than the dense engine and is not faster, even for sparse tracks.
+
+"""
+
+import logging
+from typing import Any, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from d4utils.kernels import check_int32_range
+
+logger = logging.getLogger(__name__)
+
+
+def to_runs(
+    x: npt.NDArray[Any], mask: Union[npt.NDArray[np.bool_], None] = None
+) -> tuple[npt.NDArray[np.intp], npt.NDArray[Any]]:
+    """Convert a track to runs of constant values.
+
+    Returns run start offsets and run values. `mask` is an optional
+    preallocated boolean buffer of at least len(x) - 1 elements.
+
+    >>> to_runs(np.array([0, 0, 3, 3, 3, 1]))
+    (array([0, 2, 5]), array([0, 3, 1]))
+    """
+    n = x.shape[0]
+    if n == 0:
+        return np.empty(0, dtype=np.intp), x[:0]
+    if mask is None:
+        change = np.empty(n - 1, dtype=np.bool_)
+    else:
+        change = mask[: n - 1]
+    np.not_equal(x[1:], x[:-1], out=change)
+    starts = np.flatnonzero(change)
+    starts += 1
+    starts = np.concatenate(([0], starts))
+    return starts, x[starts]
+
+
+def from_runs(
+    starts: npt.NDArray[np.intp],
+    values: npt.NDArray[Any],
+    n: int,
+    out: Union[npt.NDArray[Any], None] = None,
+) -> npt.NDArray[Any]:
+    """Expand runs to a dense track of length n.
+
+    >>> from_runs(np.array([0, 2, 5]), np.array([0, 3, 1]), 6)
+    array([0, 0, 3, 3, 3, 1])
+    """
+    lengths = np.diff(starts, append=n)
+    if out is None:
+        return np.repeat(values, lengths)
+    out = out[:n]
+    out[:] = np.repeat(values, lengths)
+    return out
+
+
+class RunAccumulator:
+    """Reduce runs from several tracks with a sweep line.
+
+    Run boundaries are recorded as value changes in a difference array
+    of length n; the reduced track is the prefix sum of the changes.
+    """
+
+    def __init__(
+        self,
+        out: npt.NDArray[np.int32],
+        *,
+        diff: Union[npt.NDArray[np.int64], None] = None,
+        mask: Union[npt.NDArray[np.bool_], None] = None,
+    ):
+        """Initialize accumulator writing to output buffer."""
+        n = out.shape[0]
+        buf = np.empty(n, dtype=np.int64) if diff is None else diff
+        assert buf.dtype == np.int64, "diff buffer must be int64"
+        self._out = out
+        self._diff = buf[:n]
+        self._diff.fill(0)
+        self._mask = mask
+
+    def add_runs(
+        self, starts: npt.NDArray[np.intp], values: npt.NDArray[Any]
+    ) -> None:
+        """Add runs of one track."""
+        if starts.shape[0] == 0:
+            return
+        # Starts are unique within a track, so fancy indexing is safe
+        self._diff[starts] += np.diff(values.astype(np.int64), prepend=0)
+
+    def result(self) -> npt.NDArray[np.int32]:
+        """Return the reduced track in the output buffer."""
+        np.cumsum(self._diff, out=self._diff)
+        check_int32_range(self._diff)
+        self._out[:] = self._diff
+        return self._out
+
+
+class RunSumAccumulator(RunAccumulator):
+    """Sum tracks by reducing their runs."""
+
+    def __init__(
+        self,
+        out: npt.NDArray[np.int32],
+        *,
+        diff: Union[npt.NDArray[np.int64], None] = None,
+        mask: Union[npt.NDArray[np.bool_], None] = None,
+    ):
+        """Initialize accumulator writing to output buffer."""
+        super().__init__(out, diff=diff, mask=mask)
+        self._bound = 0
+
+    @property
+    def bound(self) -> int:
+        """Return bound on the absolute value of the sum."""
+        return self._bound
+
+    def add(self, x: npt.NDArray[Any]) -> None:
+        """Add track values to the accumulator."""
+        if x.dtype.kind == "f":
+            raise ValueError("the runs engine requires integer tracks")
+        starts, values = to_runs(x, self._mask)
+        if values.shape[0] > 0:
+            self._bound += max(int(values.max()), -int(values.min()), 0)
+        self.add_runs(starts, values)
+
+
+class RunCountAccumulator(RunAccumulator):
+    """Count tracks with values in [min_coverage, max_coverage] by runs."""
+
+    def __init__(
+        self,
+        out: npt.NDArray[np.int32],
+        nsamples: int,
+        min_coverage: int,
+        max_coverage: Union[int, float],
+        *,
+        diff: Union[npt.NDArray[np.int64], None] = None,
+        mask: Union[npt.NDArray[np.bool_], None] = None,
+    ):
+        """Initialize accumulator for nsamples tracks."""
+        super().__init__(out, diff=diff, mask=mask)
+        self._nsamples = nsamples
+        self._min_coverage = min_coverage
+        self._max_coverage = max_coverage
+
+    @property
+    def bound(self) -> int:
+        """Return bound on the count."""
+        return self._nsamples
+
+    def add(self, x: npt.NDArray[Any]) -> None:
+        """Add one to positions whose values are within range."""
+        starts, values = to_runs(x, self._mask)
+        self.add_runs(
+            starts,
+            (values >= self._min_coverage) & (values <= self._max_coverage),
+        )
+
+    def add_counts(self, x: npt.NDArray[Any]) -> None:
+        """Add precomputed counts, such as those of a previous track."""
+        self.add_runs(*to_runs(x, self._mask))
@@ -0,0 +1,93 @@
+"""Sharded execution.
+
+A job run with `--shard I/N` only processes shard I of N of its
+regions and writes a partial d4 file with the header of the full
+output. A shard manifest next to the partial output records the job
+key, the shard and the regions it covers, so that `d4utils merge` can
+check that a set of shards is complete and copy the covered regions
+to the final output without recomputing them. It also records the
+track info of the full output, which merge writes for the merged
+track. As merge reads the shards as d4 files, sharded jobs must write
+d4 output.
+
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Union
+
+from d4utils.checkpoint import job_key
+from d4utils.d4 import D4Container
+from d4utils.sinks import sink_class
+from d4utils.update import track_info
+
+logger = logging.getLogger(__name__)
+
+SHARD_SUFFIX = ".shard.json"
+
+
+def shard_manifest_path(path: Union[str, Path]) -> Path:
+    """Return path of the shard manifest of a partial output."""
+    return Path(f"{path}{SHARD_SUFFIX}")
+
+
+def check_shard_output(d4container: D4Container) -> None:
+    """Check that a sharded job writes a d4 file that merge can read."""
+    if sink_class(d4container.outfile) is not None:
+        msg = "--shard requires a d4 OUTFILE, as merge reads d4 shards"
+        logging.error(msg)
+        raise ValueError(msg)
+
+
+def write_shard_manifest(d4container: D4Container, statistic: str) -> None:
+    """Write the shard manifest of a container's partial output."""
+    assert d4container.shard is not None, "container has no shard"
+    index, count = d4container.shard
+    chroms = d4container.chroms
+    manifest = {
+        "key": job_key(d4container, statistic, shard=False),
+        "index": index,
+        "count": count,
+        "chroms": [list(x) for x in chroms],
+        "regions": [
+            [chroms[i][0], begin, end]
+            for i, begin, end in d4container.task_regions
+        ],
+        "track": track_info(d4container, statistic),
+    }
+    with open(
+        shard_manifest_path(d4container.outfile), "w", encoding="utf-8"
+    ) as fh:
+        json.dump(manifest, fh)
+
+
+def read_shard_manifests(paths: list[Path]) -> list[dict[str, Any]]:
+    """Read and validate shard manifests of partial outputs.
+
+    Returns the manifests, with the partial output path added, in
+    shard order. Raises ValueError if a manifest is missing, the shards
+    come from different jobs or the set of shards is incomplete.
+    """
+    manifests = []
+    for path in paths:
+        fn = shard_manifest_path(path)
+        if not fn.exists():
+            logging.error(f"{path} has no shard manifest {fn}")
+            raise ValueError(f"{path} has no shard manifest {fn}")
+        with open(fn, encoding="utf-8") as fh:
+            manifest = json.load(fh)
+        manifest["path"] = path
+        manifests.append(manifest)
+    if len({(x["key"], x["count"]) for x in manifests}) > 1:
+        logging.error("Shards come from different jobs")
+        raise ValueError("Shards come from different jobs")
+    manifests.sort(key=lambda x: x["index"])
+    indices = [x["index"] for x in manifests]
+    count = manifests[0]["count"]
+    if indices != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indices))
+        msg = f"Expected shards 1..{count} once each; missing {missing}"
+        logging.error(msg)
+        raise ValueError(msg)
+    return manifests
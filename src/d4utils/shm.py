@@ -0,0 +1,100 @@
+"""Shared memory result buffers.
+
+The parent process allocates a ring of fixed-size slots in a single
+shared memory block. Workers attach to the block at start-up and write
+chunk results straight into the slot they are given, so that only the
+slot index travels back through the pool and the parent can hand a
+view of the slot to the d4 writer without copying.
+
+"""
+
+import logging
+from multiprocessing import shared_memory
+from typing import Any, Union
+
+import numpy as np
+import numpy.typing as npt
+
+logger = logging.getLogger(__name__)
+
+# Everything a worker needs to attach: (name, slots, slot size, dtype)
+RingSpec = tuple[str, int, int, str]
+
+
+class SharedBufferRing:
+    """Ring of preallocated result slots in shared memory."""
+
+    def __init__(
+        self,
+        nslots: int,
+        size: int,
+        dtype: npt.DTypeLike = np.int32,
+        *,
+        name: Union[str, None] = None,
+    ):
+        """Create a new ring or, if `name` is given, attach to one."""
+        self._nslots = nslots
+        self._size = size
+        self._dtype = np.dtype(dtype)
+        self._owner = name is None
+        nbytes = max(1, nslots * size * self._dtype.itemsize)
+        if self._owner:
+            logger.debug(
+                "Allocating %i result slots of %i x %s in shared memory",
+                nslots,
+                size,
+                self._dtype,
+            )
+            self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._array: Any = np.ndarray(
+            (nslots, size), dtype=self._dtype, buffer=self._shm.buf
+        )
+
+    @classmethod
+    def attach(cls, spec: RingSpec) -> "SharedBufferRing":
+        """Attach to an existing ring from its spec."""
+        name, nslots, size, dtype = spec
+        return cls(nslots, size, dtype, name=name)
+
+    @property
+    def spec(self) -> RingSpec:
+        """Return spec needed to attach to the ring."""
+        return self._shm.name, self._nslots, self._size, self._dtype.str
+
+    @property
+    def nslots(self) -> int:
+        """Return number of slots."""
+        return self._nslots
+
+    @property
+    def size(self) -> int:
+        """Return slot size."""
+        return self._size
+
+    @property
+    def dtype(self) -> np.dtype:
+        """Return slot dtype."""
+        return self._dtype
+
+    def __getitem__(self, slot: int) -> npt.NDArray[Any]:
+        """Return view of slot."""
+        return self._array[slot]
+
+    def close(self) -> None:
+        """Release the mapping, unlinking the block if we own it."""
+        if self._array is None:
+            return
+        self._array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self) -> "SharedBufferRing":
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Exit context and release the ring."""
+        self.close()
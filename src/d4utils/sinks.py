@@ -0,0 +1,190 @@
+"""Output sinks for formats other than d4.
+
+Sinks take the place of the pyd4 writer and are chosen by the
+extension of the output path. They implement the writer interface used
+by the engine, `write_np_array` and `close`, and, like the d4 writer,
+treat positions that are never written as zero.
+
+BedGraphSink writes runs of constant, non-zero values, found with
+`to_runs`, as bedGraph lines, joining runs that continue across chunk
+boundaries. NpyStoreSink writes a `.npyd` directory with one int32
+`.npy` array per chromosome. The arrays are memory mapped, so a sink
+that is `parallel` can be written to by the workers, each writing its
+own chunks, instead of by the parent.
+
+"""
+
+import logging
+from pathlib import Path
+from typing import Any, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from d4utils.runs import to_runs
+
+logger = logging.getLogger(__name__)
+
+
+class Sink:
+    """Output sink for chunks of an int32 track."""
+
+    # Output path extensions handled by the sink
+    suffixes: tuple[str, ...] = ()
+    # Whether chunks can be written by several workers in any order
+    parallel = False
+
+    def __init__(self, path: Union[str, Path], chroms: list[tuple[str, int]]):
+        """Initialize sink for a track with the given chromosomes."""
+        self._path = Path(path)
+        self._chroms = chroms
+
+    @property
+    def path(self) -> Path:
+        """Return path."""
+        return self._path
+
+    def write_np_array(
+        self, chrom: str, begin: int, data: npt.NDArray[Any]
+    ) -> None:
+        """Write data for chrom starting at begin."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Finish writing the track."""
+
+
+class BedGraphSink(Sink):
+    """Write a track as bedGraph lines of runs of non-zero values.
+
+    Chunks must be written in genome order. The last run of a chunk is
+    held back until the next chunk shows whether the run continues.
+    """
+
+    suffixes = (".bedgraph", ".bg")
+
+    def __init__(self, path: Union[str, Path], chroms: list[tuple[str, int]]):
+        """Initialize sink, opening the bedGraph file."""
+        super().__init__(path, chroms)
+        self._fh = open(self._path, "w", encoding="utf-8")
+        # Held back run as (chrom, begin, end, value)
+        self._run: Union[tuple[str, int, int, int], None] = None
+
+    def _flush_run(self) -> None:
+        """Write the held back run."""
+        if self._run is not None and self._run[3] != 0:
+            self._fh.write("%s\t%i\t%i\t%i\n" % self._run)
+        self._run = None
+
+    def write_np_array(
+        self, chrom: str, begin: int, data: npt.NDArray[Any]
+    ) -> None:
+        """Write runs of data for chrom starting at begin."""
+        if data.shape[0] == 0:
+            return
+        starts, values = to_runs(data)
+        starts = starts + begin
+        ends = np.append(starts[1:], begin + data.shape[0])
+        run = self._run
+        if run is not None and run[0] == chrom and run[2] == begin:
+            if run[3] == values[0]:
+                starts[0] = run[1]
+                self._run = None
+        self._flush_run()
+        keep = values[:-1] != 0
+        rows = np.column_stack((starts[:-1], ends[:-1], values[:-1]))[keep]
+        if rows.shape[0] > 0:
+            fmt = chrom.replace("%", "%%") + "\t%i\t%i\t%i"
+            np.savetxt(self._fh, rows, fmt=fmt)
+        self._run = (chrom, int(starts[-1]), int(ends[-1]), int(values[-1]))
+
+    def close(self) -> None:
+        """Write the last run and close the file."""
+        if self._fh.closed:
+            return
+        self._flush_run()
+        self._fh.close()
+
+
+# Memory maps of store arrays opened in this process, keyed by path
+_arrays: dict[str, np.memmap] = {}
+
+
+def _open_array(path: Path) -> np.memmap:
+    """Return memory map of an existing store array."""
+    key = str(path)
+    array = _arrays.get(key)
+    if array is None:
+        array = np.lib.format.open_memmap(key, mode="r+")
+        _arrays[key] = array
+    return array
+
+
+class NpyStoreSink(Sink):
+    """Write a track as a directory of per-chromosome `.npy` arrays.
+
+    The directory has the suffix `.npyd`, as it is not itself an array
+    that `np.load` can open. The arrays are created zero-filled, as
+    sparse files, when the sink is created, and chunks are copied into
+    memory maps of them. Chunks can be written in any order and from
+    several processes, as they are disjoint; the sink is pickled by path
+    and reopens the arrays in the process it is used in.
+    """
+
+    suffixes = (".npyd",)
+    parallel = True
+
+    def __init__(self, path: Union[str, Path], chroms: list[tuple[str, int]]):
+        """Initialize sink, creating the store directory and arrays."""
+        super().__init__(path, chroms)
+        self._path.mkdir(parents=True, exist_ok=True)
+        for chrom, length in chroms:
+            fn = self.array_path(chrom)
+            _arrays[str(fn)] = np.lib.format.open_memmap(
+                str(fn), mode="w+", dtype=np.int32, shape=(length,)
+            )
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Return state for pickling."""
+        return {"_path": self._path, "_chroms": self._chroms}
+
+    def array_path(self, chrom: str) -> Path:
+        """Return path of the array of a chromosome."""
+        return self._path / f"{chrom}.npy"
+
+    def write_np_array(
+        self, chrom: str, begin: int, data: npt.NDArray[Any]
+    ) -> None:
+        """Copy data for chrom starting at begin to the chromosome array."""
+        array = _open_array(self.array_path(chrom))
+        array[begin : begin + data.shape[0]] = data
+
+    def close(self) -> None:
+        """Flush the arrays to disk."""
+        for chrom, _ in self._chroms:
+            array = _arrays.pop(str(self.array_path(chrom)), None)
+            if array is not None:
+                array.flush()
+
+
+SINKS: tuple[type[Sink], ...] = (BedGraphSink, NpyStoreSink)
+
+
+def sink_class(path: Union[str, Path]) -> Union[type[Sink], None]:
+    """Return sink class for the extension of path, or None for d4."""
+    suffix = Path(path).suffix.lower()
+    for sink in SINKS:
+        if suffix in sink.suffixes:
+            return sink
+    return None
+
+
+def get_sink(
+    path: Union[str, Path], chroms: list[tuple[str, int]]
+) -> Union[Sink, None]:
+    """Return sink for the extension of path, or None for d4 output."""
+    sink = sink_class(path)
+    if sink is None:
+        return None
+    logger.info("Writing %s with %s", path, sink.__name__)
+    return sink(path, chroms)
@@ -0,0 +1,215 @@
+# type: ignore
+"""Compute several statistics across d4 coverage tracks in one pass.
+
+Read each chunk of multiple d4 files once and compute the sum, mean,
+min, max and variance across samples and the number of samples with
+coverage in each of a list of bins. Each statistic is written to its
+own d4 file, named by inserting the statistic name before the OUTFILE
+suffix, or to a multi-track OUTFILE with --multi-track.
+
+"""
+
+import functools
+import json
+import logging
+import pathlib
+import sys
+from typing import Union
+
+import click
+import pyd4
+
+from d4utils.arguments import outfile
+from d4utils.checkpoint import make_checkpoint
+from d4utils.d4 import D4Container, Region
+from d4utils.engine import EngineOptions, WorkerTask, process_chunks
+from d4utils.kernels import (
+    STATISTICS,
+    StatsAccumulator,
+    stats_bytes_per_base,
+    track_names,
+)
+from d4utils.metrics import JobReport
+from d4utils.options import (
+    bin_option,
+    checkpoint_option,
+    chunk_size_option,
+    cores_option,
+    executor_option,
+    memory_budget_option,
+    metrics_interval_option,
+    metrics_out_option,
+    prefetch_option,
+    profile_option,
+    regions_option,
+    resume_option,
+    scale_option,
+    statistic_option,
+    window_size_option,
+    write_batch_option,
+)
+from d4utils.options import verbose_option as verbose
+from d4utils.sinks import sink_class
+from d4utils.worker import (
+    get_container,
+    load_samples,
+    result_buffer,
+    scratch_buffer,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def track_outfiles(
+    outfile: pathlib.Path, names: list[str], multi_track: bool
+) -> list[pathlib.Path]:
+    """Return single-track output paths for track names.
+
+    >>> track_outfiles(pathlib.Path("out.d4"), ["sum", "mean"], False)
+    [PosixPath('out.sum.d4'), PosixPath('out.mean.d4')]
+    """
+    outfile = pathlib.Path(outfile)
+    if multi_track:
+        return [pathlib.Path(f"{outfile}.{name}.d4") for name in names]
+    return [outfile.with_suffix(f".{name}{outfile.suffix}") for name in names]
+
+
+@click.command(help=__doc__)
+@verbose()
+@click.argument("path", nargs=-1, type=click.Path(exists=True))
+@outfile()
+@regions_option()
+@chunk_size_option()
+@memory_budget_option()
+@statistic_option()
+@bin_option()
+@scale_option()
+@click.option(
+    "--multi-track",
+    help="write statistics as tracks of a multi-track OUTFILE",
+    is_flag=True,
+    default=False,
+)
+@cores_option()
+@executor_option()
+@window_size_option()
+@prefetch_option()
+@write_batch_option()
+@profile_option()
+@metrics_out_option()
+@metrics_interval_option()
+@checkpoint_option()
+@resume_option()
+def stats(
+    path: list[pathlib.Path],
+    outfile: pathlib.Path,
+    regions: Union[list[Region], None],
+    chunk_size: Union[int, None],
+    memory_budget: Union[int, None],
+    statistics: tuple[str, ...],
+    bins: list[tuple[int, Union[int, float]]],
+    scale: float,
+    multi_track: bool,
+    cores: int,
+    executor: str,
+    window_size: int,
+    prefetch: int,
+    write_batch: Union[int, None],
+    profile: bool,
+    metrics_out: Union[str, None],
+    metrics_interval: Union[float, None],
+    checkpoint: bool,
+    resume: bool,
+) -> None:
+    """Compute statistics."""
+    if not statistics:
+        statistics = STATISTICS
+    if multi_track and sink_class(outfile) is not None:
+        msg = "--multi-track requires a d4 OUTFILE"
+        logging.error(msg)
+        raise ValueError(msg)
+    names = track_names(statistics, bins)
+    outfiles = track_outfiles(outfile, names, multi_track)
+    for fn in outfiles:
+        if fn.exists() and not resume:
+            logging.error(
+                f"{fn} exists! Make sure to provide "
+                "a non-existing output file name"
+            )
+            sys.exit(1)
+    d4container = D4Container(
+        path, outfile=outfile, chunk_size=chunk_size, regions=regions
+    )
+
+    tqdm_disable = logger.getEffectiveLevel() > logging.INFO
+
+    report = None
+    if profile or metrics_out is not None:
+        report = JobReport(metrics_out, metrics_interval)
+
+    func = functools.partial(
+        process_region_chunk, list(statistics), bins, scale
+    )
+    options = EngineOptions(
+        cores=cores,
+        window_size=window_size,
+        memory_budget=memory_budget,
+        prefetch=prefetch,
+        reduce_bytes=stats_bytes_per_base(len(path), statistics, bins),
+        write_batch=write_batch,
+        executor=executor,
+        report=report,
+        tqdm_disable=tqdm_disable,
+    )
+    process_chunks(
+        d4container,
+        func,
+        options,
+        checkpoint=make_checkpoint(
+            d4container, f"stats:{','.join(names)}:{scale}", checkpoint, resume
+        ),
+        outfiles=outfiles,
+    )
+    if multi_track:
+        pathlib.Path(outfile).unlink(missing_ok=True)
+        merger = pyd4.D4Merger(str(outfile))
+        for name, fn in zip(names, outfiles):
+            merger.add_tagged_track(name, str(fn))
+        merger.merge()
+        for fn in outfiles:
+            fn.unlink()
+    if profile:
+        click.echo(json.dumps(report.report(), indent=2), err=True)
+
+
+def process_region_chunk(
+    statistics: list[str],
+    bins: list[tuple[int, Union[int, float]]],
+    scale: float,
+    task: WorkerTask,
+) -> int:
+    """Process region chunk.
+
+    All statistics for the chunk are computed from a single decode of
+    each sample and written as rows of the shared memory slot given by
+    the task. Returns 0, as sample groups are not supported.
+    """
+    d4c = get_container()
+    slot, chrom_index, begin, end, sample_begin, sample_end = task
+    chrom_name, _ = d4c.chroms[chrom_index]
+    n = end - begin
+    names = track_names(statistics, bins)
+    out = result_buffer(slot).reshape(len(names), -1)[:, :n]
+    acc = StatsAccumulator(
+        n,
+        sample_end - sample_begin,
+        statistics,
+        bins,
+        scale=scale,
+        alloc=lambda key, dtype: scratch_buffer(n, dtype, key),
+    )
+    paths = d4c.path[sample_begin:sample_end]
+    for x in load_samples(paths, chrom_name, begin, end):
+        acc.add(x)
+    acc.result(out)
+    return 0
@@ -0,0 +1,98 @@
+"""Histogram summaries of reduced tracks.
+
+Instead of writing a per-base track, a summary holds a histogram of
+the reduced values of every region and of all regions together.
+Workers histogram their chunks and only return the small histogram
+arrays, and the summary is written in the format of `bedtools
+coverage -hist`: one line per region and value,
+
+    chrom  begin  end  value  bases  region length  fraction
+
+followed by genome-wide lines with `all` in place of the region.
+Only values that occur are written.
+
+"""
+
+import logging
+from pathlib import Path
+from typing import Any, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from d4utils.d4 import ChunkTask
+
+logger = logging.getLogger(__name__)
+
+
+def add_counts(
+    total: npt.NDArray[np.int64], counts: npt.NDArray[np.int64]
+) -> None:
+    """Add histogram counts, which may be shorter, to total in place."""
+    total[: counts.shape[0]] += counts
+
+
+class HistogramSummary:
+    """Per-region and genome-wide histograms written as they complete.
+
+    Regions must be added in order; the histogram of a region is
+    written once a chunk of a later region is added.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        chroms: list[tuple[str, int]],
+        regions: list[ChunkTask],
+        max_value: int,
+    ):
+        """Initialize summary writing to path."""
+        self._chroms = chroms
+        self._regions = regions
+        self._max_value = max_value
+        self._total = np.zeros(max_value + 1, dtype=np.int64)
+        self._counts = np.zeros(max_value + 1, dtype=np.int64)
+        self._current: Union[int, None] = None
+        self._fh: Any = open(path, "w", encoding="utf-8")
+
+    @property
+    def max_value(self) -> int:
+        """Return largest value with its own bin."""
+        return self._max_value
+
+    def _write_region(self) -> None:
+        if self._current is None:
+            return
+        chrom_index, begin, end = self._regions[self._current]
+        chrom_name = self._chroms[chrom_index][0]
+        length = end - begin
+        for value in np.flatnonzero(self._counts):
+            bases = int(self._counts[value])
+            self._fh.write(
+                f"{chrom_name}\t{begin}\t{end}\t{value}\t{bases}\t"
+                f"{length}\t{bases / length:.6g}\n"
+            )
+        self._total += self._counts
+        self._counts.fill(0)
+
+    def add(self, region: int, counts: npt.NDArray[np.int64]) -> None:
+        """Add histogram counts of a chunk of region index `region`."""
+        if region != self._current:
+            self._write_region()
+            self._current = region
+        add_counts(self._counts, counts)
+
+    def close(self) -> None:
+        """Write the last region and the genome-wide histogram."""
+        if self._fh is None:
+            return
+        self._write_region()
+        self._current = None
+        size = int(self._total.sum())
+        for value in np.flatnonzero(self._total):
+            bases = int(self._total[value])
+            self._fh.write(
+                f"all\t{value}\t{bases}\t{size}\t{bases / size:.6g}\n"
+            )
+        self._fh.close()
+        self._fh = None
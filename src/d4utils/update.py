@@ -0,0 +1,126 @@
+"""Track information and incremental updates.
+
+Every track written by sum or count is accompanied by a track info
+file, OUTFILE.info.json, that records the statistic, the coverage
+range, the samples, chromosomes and regions of the track. A track can
+then be updated with new samples by passing it to `--update`: it is
+read chunk by chunk as the partial result of the previous samples and
+only the new samples are decoded. The track info of the previous
+track is used to check that the update is consistent.
+
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Union
+
+import pyd4
+
+from d4utils.d4 import D4Container
+
+logger = logging.getLogger(__name__)
+
+INFO_SUFFIX = ".info.json"
+
+
+def track_info_path(path: Union[str, Path]) -> Path:
+    """Return path of the track info of a track."""
+    return Path(f"{path}{INFO_SUFFIX}")
+
+
+def read_track_info(path: Union[str, Path]) -> Union[dict[str, Any], None]:
+    """Return track info of a track, or None if it has none."""
+    fn = track_info_path(path)
+    if not fn.exists():
+        return None
+    with open(fn, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def track_config(d4container: D4Container, statistic: str) -> dict[str, Any]:
+    """Return the configuration that a track update must match."""
+    chroms = d4container.chroms
+    return {
+        "statistic": statistic,
+        "min_coverage": float(d4container.min_coverage),
+        "max_coverage": float(d4container.max_coverage),
+        "chroms": [list(x) for x in chroms],
+        "regions": [
+            [chroms[i][0], begin, end] for i, begin, end in d4container.regions
+        ],
+    }
+
+
+def previous_samples(d4container: D4Container) -> list[str]:
+    """Return samples of the track updated by the container, if known."""
+    if d4container.update is None:
+        return []
+    info = read_track_info(d4container.update)
+    return [] if info is None else info["samples"]
+
+
+def track_info(d4container: D4Container, statistic: str) -> dict[str, Any]:
+    """Return track info of the container's outfile."""
+    info = track_config(d4container, statistic)
+    samples = previous_samples(d4container)
+    info["samples"] = samples + [
+        str(Path(x).resolve()) for x in d4container.path
+    ]
+    info["nsamples"] = len(info["samples"])
+    return info
+
+
+def save_track_info(path: Union[str, Path], info: dict[str, Any]) -> None:
+    """Write track info of a track."""
+    with open(track_info_path(path), "w", encoding="utf-8") as fh:
+        json.dump(info, fh, indent=2)
+
+
+def write_track_info(d4container: D4Container, statistic: str) -> None:
+    """Write track info of the container's outfile."""
+    save_track_info(d4container.outfile, track_info(d4container, statistic))
+
+
+def check_update(d4container: D4Container, statistic: str) -> int:
+    """Check that the container's update track can be updated.
+
+    The track must have the container's chromosomes and, if it has
+    track info, the same statistic, coverage range and regions, and
+    none of the new samples. Returns the number of samples of the
+    track, which is 0 if it has no track info.
+    """
+    path = d4container.update
+    assert path is not None, "container has no track to update"
+    if [tuple(x) for x in pyd4.D4File(str(path)).chroms()] != [
+        tuple(x) for x in d4container.chroms
+    ]:
+        msg = f"{path} does not have the chromosomes of the new samples"
+        logging.error(msg)
+        raise ValueError(msg)
+    info = read_track_info(path)
+    if info is None:
+        logger.warning(
+            "%s has no track info; cannot check that it was made by %s "
+            "with the same options",
+            path,
+            statistic,
+        )
+        return 0
+    config = track_config(d4container, statistic)
+    for key, value in config.items():
+        if key != "chroms" and info[key] != value:
+            msg = (
+                f"{path} was made with {key} {info[key]}, "
+                f"but the update uses {value}"
+            )
+            logging.error(msg)
+            raise ValueError(msg)
+    overlap = set(info["samples"]) & {
+        str(Path(x).resolve()) for x in d4container.path
+    }
+    if overlap:
+        msg = f"{path} already includes samples {sorted(overlap)}"
+        logging.error(msg)
+        raise ValueError(msg)
+    return int(info["nsamples"])
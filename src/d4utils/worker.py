@@ -0,0 +1,321 @@
+"""Worker-side state for the pool.
+
+The state of a job, its D4Container, result ring, prefetch depth and
+the output sink written to by workers, if any, is held by a
+JobContext, so that submitted tasks only need to carry compact chunk
+coordinates. Each worker process receives the context once at
+start-up, through `init_worker`. Thread and serial pools run in the
+parent, where several jobs may be in progress at once, so their tasks
+are instead bound to the context of their job with `bind_context`. The
+context also caches the header metadata of the input files, so that
+chromosome tables and denominators are read once per worker rather
+than once per chunk; pyd4 reopens a file for every load, so no file
+descriptors are held. Results are written to a shared memory ring set
+up by the parent, and decoding goes through a reusable scratch buffer.
+Samples can be prefetched by a background thread, so that decoding the
+next sample overlaps with accumulating the current one.
+
+Scratch buffers and the prefetch thread are kept per worker thread,
+so that the same functions serve process, thread and serial pools.
+
+"""
+
+import contextlib
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterator, Sequence, Union
+
+import numpy as np
+import numpy.typing as npt
+import pyd4
+
+from d4utils.d4 import D4Container
+from d4utils.metrics import add_time, count, current, recording, timer
+from d4utils.shm import RingSpec, SharedBufferRing
+from d4utils.sinks import Sink
+
+logger = logging.getLogger(__name__)
+
+
+class CachedD4File:
+    """Single-track d4 file with cached header metadata.
+
+    The chromosome table and denominator are read once when the object
+    is created, so loading a region only decodes the requested values.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Read the header information of a d4 file."""
+        self._path = str(path)
+        self._fh = pyd4.D4File(self._path)
+        self._chroms = dict(self._fh.chroms())
+        self._denominator = self._fh.get_denominator()
+
+    @property
+    def path(self) -> str:
+        """Return path."""
+        return self._path
+
+    @property
+    def chroms(self) -> dict[str, int]:
+        """Return chromosome lengths keyed by chromosome name."""
+        return self._chroms
+
+    def load(
+        self,
+        chrom: str,
+        begin: int,
+        end: int,
+        out: Union[npt.NDArray[np.int32], Any] = None,
+    ) -> npt.NDArray[Any]:
+        """Load region values to a numpy array.
+
+        If `out` is given, values are decoded directly into its first
+        `end - begin` elements, which are returned as a view. Files
+        with a denominator other than 1 return a new float64 array of
+        the scaled values.
+        """
+        n = end - begin
+        if out is None:
+            out = np.zeros(n, dtype=np.int32)
+        else:
+            assert out.dtype == np.int32, "out buffer must be int32"
+            assert out.flags.c_contiguous, "out buffer must be contiguous"
+            out = out[:n]
+            if end > self._chroms.get(chrom, 0):
+                out.fill(0)
+        with timer("decode"):
+            self._fh.load_values_to_buffer(chrom, begin, end, out.ctypes.data)
+        count("bytes_decoded", 4 * n)
+        if self._denominator != 1.0:
+            return out / self._denominator
+        return out
+
+
+class JobContext:
+    """State of a job shared by all its tasks."""
+
+    def __init__(
+        self,
+        container: D4Container,
+        ring: Union[RingSpec, SharedBufferRing],
+        prefetch: int = 1,
+        sink: Union[Sink, None] = None,
+    ):
+        """Initialize context of a job.
+
+        Process workers are given the spec of the ring and attach to
+        it, while thread and serial workers, which share the parent's
+        memory, are given the ring itself.
+        """
+        self.container = container
+        self.ring = ring
+        self.prefetch = prefetch
+        self.sink = sink
+        self.files: dict[str, CachedD4File] = {}
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Return state for pickling, without cached files."""
+        return {**self.__dict__, "files": {}}
+
+    def attach(self) -> None:
+        """Attach to the ring if the context holds its spec."""
+        if not isinstance(self.ring, SharedBufferRing):
+            self.ring = SharedBufferRing.attach(self.ring)
+
+
+class WorkerState:
+    """Caches of a worker thread."""
+
+    def __init__(self) -> None:
+        """Initialize empty caches."""
+        self.scratch: dict[str, npt.NDArray[Any]] = {}
+        self.prefetch_pool: Union[ThreadPoolExecutor, None] = None
+
+
+_local = threading.local()
+# Context of the job a worker process was started for
+_context: Union[JobContext, None] = None
+
+
+def worker_state() -> WorkerState:
+    """Return the caches of the current worker thread."""
+    state = getattr(_local, "state", None)
+    if state is None:
+        state = _local.state = WorkerState()
+    return state
+
+
+def _share_state(state: WorkerState) -> None:
+    """Make the current thread use the caches of another thread."""
+    _local.state = state
+
+
+def init_worker(context: JobContext) -> None:
+    """Initialize a worker process with the context of its job.
+
+    Meant to be passed as `initializer` to a process pool.
+    """
+    global _context
+    # A forked process inherits the caches of the thread that forked,
+    # including a prefetch pool whose thread it does not have
+    state = getattr(_local, "state", None)
+    if state is not None and state.prefetch_pool is not None:
+        state.prefetch_pool.shutdown(wait=False)
+    _local.state = WorkerState()
+    context.attach()
+    _context = context
+
+
+@contextlib.contextmanager
+def bound(context: JobContext) -> Iterator[None]:
+    """Make context the job context of the current thread."""
+    previous = getattr(_local, "context", None)
+    _local.context = context
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+def run_in_context(
+    context: JobContext, func: Callable[[Any], Any], task: Any
+) -> Any:
+    """Run func on a task with context as the job context."""
+    with bound(context):
+        return func(task)
+
+
+def bind_context(
+    context: JobContext, func: Callable[[Any], Any]
+) -> Callable[[Any], Any]:
+    """Return func bound to run its tasks in a job context.
+
+    Used for thread and serial pools, whose workers may run tasks of
+    several jobs.
+    """
+    return functools.partial(run_in_context, context, func)
+
+
+def current_context() -> JobContext:
+    """Return the context of the job of the running task."""
+    context = getattr(_local, "context", None) or _context
+    if context is None:
+        raise RuntimeError("worker has not been initialized with a job")
+    return context
+
+
+def get_container() -> D4Container:
+    """Return the job configuration of the running task."""
+    return current_context().container
+
+
+def get_sink() -> Sink:
+    """Return the output sink of the running task's job."""
+    sink = current_context().sink
+    if sink is None:
+        raise RuntimeError("job has no sink written to by workers")
+    return sink
+
+
+def result_buffer(slot: int) -> npt.NDArray[Any]:
+    """Return view of shared memory result slot."""
+    ring = current_context().ring
+    assert isinstance(ring, SharedBufferRing), "ring is not attached"
+    return ring[slot]
+
+
+def scratch_buffer(
+    size: int, dtype: npt.DTypeLike = np.int32, key: str = "decode"
+) -> npt.NDArray[Any]:
+    """Return reusable scratch buffer of at least size elements.
+
+    Buffers are kept per worker thread under `key` and are reallocated only
+    when a larger size or a different dtype is requested.
+    """
+    scratch = worker_state().scratch
+    buf = scratch.get(key)
+    if buf is None or buf.shape[0] < size or buf.dtype != np.dtype(dtype):
+        buf = np.empty(size, dtype=dtype)
+        scratch[key] = buf
+    return buf
+
+
+def cached_d4(path: Union[str, Path]) -> CachedD4File:
+    """Return d4 file with cached metadata for path, reading it if needed."""
+    key = str(path)
+    files = current_context().files
+    fh = files.get(key)
+    if fh is None:
+        with timer("open"):
+            fh = CachedD4File(key)
+        count("headers_read")
+        files[key] = fh
+    return fh
+
+
+def load_samples(
+    paths: Sequence[Union[str, Path]], chrom: str, begin: int, end: int
+) -> Iterator[npt.NDArray[Any]]:
+    """Iterate over the values of a region in several d4 files.
+
+    With prefetching enabled, up to `prefetch` files are decoded ahead
+    by a background thread into rotating scratch buffers while the
+    caller processes the current one. pyd4 holds the GIL while it
+    decodes, so one thread is used, and the overlap comes from NumPy
+    releasing the GIL in the caller's accumulation. A yielded array is
+    only valid until the next one is requested, and may be modified by
+    the caller.
+    """
+    n = end - begin
+    context = current_context()
+    prefetch = context.prefetch
+    if prefetch < 1:
+        for p in paths:
+            data = cached_d4(p).load(chrom, begin, end, out=scratch_buffer(n))
+            start = time.perf_counter()
+            yield data
+            add_time("accumulate", time.perf_counter() - start)
+        return
+    state = worker_state()
+    if state.prefetch_pool is None:
+        # The prefetch thread shares the worker thread's caches
+        state.prefetch_pool = ThreadPoolExecutor(
+            1, initializer=_share_state, initargs=(state,)
+        )
+    pool = state.prefetch_pool
+    metrics = current()
+    nbuf = prefetch + 1
+    buffers = [scratch_buffer(n, key=f"prefetch{i}") for i in range(nbuf)]
+
+    def load(i: int) -> npt.NDArray[Any]:
+        out = buffers[i % nbuf]
+        with recording(metrics), bound(context):
+            return cached_d4(paths[i]).load(chrom, begin, end, out=out)
+
+    pending: "deque[Future[npt.NDArray[Any]]]" = deque(
+        pool.submit(load, i) for i in range(min(prefetch, len(paths)))
+    )
+    try:
+        for i in range(len(paths)):
+            with timer("decode_wait"):
+                data = pending.popleft().result()
+            if i + prefetch < len(paths):
+                # The buffer of sample i - 1 is free once sample i is
+                # requested
+                pending.append(pool.submit(load, i + prefetch))
+            start = time.perf_counter()
+            yield data
+            add_time("accumulate", time.perf_counter() - start)
+    finally:
+        # Do not leave decodes into buffers that will be reused
+        for future in pending:
+            future.cancel()
+        for future in pending:
+            if not future.cancelled():
+                future.exception()
@@ -0,0 +1,69 @@
+"""Batched d4 output.
+
+The pyd4 writer splits every chromosome into parts of
+`WRITER_PART_SIZE` bases and encodes the parts touched by one
+`write_np_array` call in parallel on native threads. Chunk results are
+usually at most one part long, so writing them one by one encodes on a
+single thread. BatchWriter coalesces consecutive chunks into batches
+spanning many parts, so that each write is encoded in parallel.
+
+"""
+
+import logging
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+import pyd4
+
+logger = logging.getLogger(__name__)
+
+# Size of the parts that pyd4 encodes in parallel
+WRITER_PART_SIZE = 1_000_000
+
+
+class BatchWriter:
+    """Coalesce contiguous writes to a d4 writer into batches.
+
+    Data passed to `write_np_array` is copied into an int32 batch of
+    `batch_size` bases, which is written when the next chunk is not
+    contiguous with it or does not fit, and when the writer is closed.
+    Chunks at least as large as the batch are written directly.
+    """
+
+    def __init__(self, writer: pyd4.D4Writer, batch_size: int):
+        """Initialize batch writer wrapping a pyd4 writer."""
+        self._writer = writer
+        self._buffer = np.empty(batch_size, dtype=np.int32)
+        self._chrom = ""
+        self._begin = 0
+        self._size = 0
+
+    def flush(self) -> None:
+        """Write the current batch."""
+        if self._size > 0:
+            self._writer.write_np_array(
+                self._chrom, self._begin, self._buffer[: self._size]
+            )
+            self._size = 0
+
+    def write_np_array(
+        self, chrom: str, begin: int, data: npt.NDArray[Any]
+    ) -> None:
+        """Add data for chrom starting at begin to the batch."""
+        n = data.shape[0]
+        contiguous = chrom == self._chrom and begin == self._begin + self._size
+        if not contiguous or self._size + n > self._buffer.shape[0]:
+            self.flush()
+        if n >= self._buffer.shape[0]:
+            self._writer.write_np_array(chrom, begin, data)
+            return
+        if self._size == 0:
+            self._chrom, self._begin = chrom, begin
+        self._buffer[self._size : self._size + n] = data
+        self._size += n
+
+    def close(self) -> None:
+        """Write the last batch and close the writer."""
+        self.flush()
+        self._writer.close()
@@ -1,9 +1,15 @@
 """Test basic d4 functions."""
 
+import json
+
 import numpy as np
 import pyd4
 import pytest
+from d4utils.checkpoint import make_checkpoint
 from d4utils.count import count
+from d4utils.d4 import D4Container
+from d4utils.merge import merge
+from d4utils.stats import stats
 from d4utils.sum import sum
 
 
@@ -97,12 +103,325 @@ def test_sum(runner, d1, d2, d3) -> None:
     assert np.all(x[500:1000] == 2)
 
 
+def test_sum_runs(runner, d1, d2, d3) -> None:
+    """Test sum with the runs engine."""
+    out = d1.dirpath() / "out_runs.d4"
+    result = runner.invoke(
+        sum,
+        [str(d1), str(d2), str(d3), str(out), "--engine", "runs"]
+        + ["--chunk-size", "300"],
+    )
+    assert result.exit_code == 0
+    file = pyd4.D4File(str(out))
+    x = file.load_to_np("chr1")
+    assert np.all(x[0:500] == 1)
+    assert np.all(x[500:1000] == 2)
+
+
+def test_sum_sample_groups(runner, d1, d2, d3) -> None:
+    """Test sum with samples split over several workers."""
+    out = d1.dirpath() / "out_sample_groups.d4"
+    result = runner.invoke(
+        sum,
+        [str(d1), str(d2), str(d3), str(out), "--sample-groups", "2"]
+        + ["-j", "2"],
+    )
+    assert result.exit_code == 0
+    file = pyd4.D4File(str(out))
+    x = file.load_to_np("chr1")
+    assert np.all(x[0:500] == 1)
+    assert np.all(x[500:1000] == 2)
+
+
+def test_sum_overflow(runner, d4_factory, tmpdir_factory) -> None:
+    """Test sum exceeding the int32 range of d4 fails."""
+    outdir = tmpdir_factory.mktemp("d4")
+    paths = [
+        d4_factory(
+            chroms=[("chr1", 1000)],
+            coverage={"chr1": np.full(1000, 2**30, dtype=np.int32)},
+            prefix=f"large{i}",
+            outdir=outdir,
+        )
+        for i in range(2)
+    ]
+    out = outdir / "out_overflow.d4"
+    result = runner.invoke(sum, [str(x) for x in paths] + [str(out)])
+    assert result.exit_code != 0
+    assert isinstance(result.exception, OverflowError)
+
+
+def test_sum_regions(runner, d1, d2, d3) -> None:
+    """Test sum restricted to overlapping sub-chromosome regions."""
+    bed = d1.dirpath() / "regions.bed"
+    bed.write_text("chr1\t450\t550\nchr1\t400\t500\n", encoding="utf-8")
+    out = d1.dirpath() / "out_regions.d4"
+    result = runner.invoke(
+        sum,
+        [str(d1), str(d2), str(d3), str(out), "-R", str(bed)]
+        + ["--chunk-size", "60"],
+    )
+    assert result.exit_code == 0
+    file = pyd4.D4File(str(out))
+    x = file.load_to_np("chr1")
+    assert np.all(x[0:400] == 0)
+    assert np.all(x[400:500] == 1)
+    assert np.all(x[500:550] == 2)
+    assert np.all(x[550:1000] == 0)
+
+
+def test_sum_resume(runner, d1, d2, d3) -> None:
+    """Test resumed sum reuses staged chunks and computes the rest."""
+    out = d1.dirpath() / "out_resume.d4"
+    paths = [str(d1), str(d2), str(d3)]
+    args = paths + [str(out), "--chunk-size", "300"]
+    result = runner.invoke(sum, args + ["--checkpoint"])
+    assert result.exit_code == 0
+    assert not (d1.dirpath() / "out_resume.d4.checkpoint").exists()
+    # Stage a marker chunk, as left behind by an interrupted run
+    d4container = D4Container(paths, outfile=out, chunk_size=300)
+    ckpt = make_checkpoint(d4container, "sum", True, False)
+    ckpt.open(300)
+    ckpt.stage(1, np.full(300, 7, dtype=np.int32))
+    ckpt.close()
+    result = runner.invoke(sum, args + ["--resume"])
+    assert result.exit_code == 0
+    x = pyd4.D4File(str(out)).load_to_np("chr1")
+    assert np.all(x[0:300] == 1)
+    assert np.all(x[300:600] == 7)
+    assert np.all(x[600:1000] == 2)
+    # A header truncated by a kill is treated as no checkpoint
+    ckpt.open(300)
+    ckpt.close()
+    manifest = d1.dirpath() / "out_resume.d4.checkpoint" / "manifest.jsonl"
+    manifest.write_text('{"key": ', encoding="utf-8")
+    result = runner.invoke(sum, args + ["--resume"])
+    assert result.exit_code == 0
+    x = pyd4.D4File(str(out)).load_to_np("chr1")
+    assert np.all(x[0:500] == 1)
+
+
+def test_sum_shard_merge(runner, d1, d2, d3) -> None:
+    """Test sum split over shards and merged."""
+    paths = [str(d1), str(d2), str(d3)]
+    shards = [d1.dirpath() / f"out_shard{i}.d4" for i in (1, 2, 3)]
+    for i, out in enumerate(shards, 1):
+        result = runner.invoke(
+            sum, paths + [str(out), "--shard", f"{i}/3", "--chunk-size", "70"]
+        )
+        assert result.exit_code == 0
+    out = d1.dirpath() / "out_merged.d4"
+    result = runner.invoke(merge, [str(x) for x in shards] + [str(out)])
+    assert result.exit_code == 0
+    x = pyd4.D4File(str(out)).load_to_np("chr1")
+    assert np.all(x[0:500] == 1)
+    assert np.all(x[500:1000] == 2)
+    info = d1.dirpath() / "out_merged.d4.info.json"
+    info = json.loads(info.read_text("utf-8"))
+    assert info["statistic"] == "sum"
+    assert info["nsamples"] == 3
+    result = runner.invoke(merge, [str(shards[0]), str(out) + ".incomplete"])
+    assert result.exit_code != 0
+    out = d1.dirpath() / "out_shard.bedgraph"
+    result = runner.invoke(sum, paths + [str(out), "--shard", "1/3"])
+    assert result.exit_code != 0
+
+
+def test_count_summary(runner, d1, d2, d3) -> None:
+    """Test count summary histograms over regions."""
+    bed = d1.dirpath() / "summary.bed"
+    bed.write_text("chr1\t0\t100\nchr1\t400\t600\n", encoding="utf-8")
+    out = d1.dirpath() / "out_summary.tsv"
+    result = runner.invoke(
+        count,
+        [str(d1), str(d2), str(d3), str(out), "-R", str(bed), "--summary"]
+        + ["--min-coverage", "1", "--chunk-size", "70", "-j", "2"],
+    )
+    assert result.exit_code == 0
+    lines = [x.split("\t") for x in out.read_text("utf-8").splitlines()]
+    assert lines == [
+        ["chr1", "0", "100", "1", "100", "100", "1"],
+        ["chr1", "400", "600", "1", "100", "200", "0.5"],
+        ["chr1", "400", "600", "2", "100", "200", "0.5"],
+        ["all", "1", "200", "300", "0.666667"],
+        ["all", "2", "100", "300", "0.333333"],
+    ]
+
+
+def test_count_update(runner, d1, d2, d3, d4) -> None:
+    """Test count update with new samples."""
+    opts = ["--min-coverage", "1", "--chunk-size", "300", "-j", "2"]
+    full = d1.dirpath() / "count_full.d4"
+    prev = d1.dirpath() / "count_prev.d4"
+    out = d1.dirpath() / "count_update.d4"
+    result = runner.invoke(
+        count, [str(d1), str(d2), str(d3), str(d4), str(full)] + opts
+    )
+    assert result.exit_code == 0
+    result = runner.invoke(count, [str(d1), str(d2), str(prev)] + opts)
+    assert result.exit_code == 0
+    result = runner.invoke(
+        count, [str(d3), str(d4), str(out), "--update", str(prev)] + opts
+    )
+    assert result.exit_code == 0
+    x = pyd4.D4File(str(out)).load_to_np("chr1")
+    assert np.all(x == pyd4.D4File(str(full)).load_to_np("chr1"))
+    info = d1.dirpath() / "count_update.d4.info.json"
+    info = json.loads(info.read_text("utf-8"))
+    assert info["nsamples"] == 4
+    result = runner.invoke(
+        count,
+        [str(d2), str(d1.dirpath() / "count_again.d4"), "--update", str(out)]
+        + opts,
+    )
+    assert result.exit_code != 0
+
+
+def test_sum_metrics(runner, d1, d2, d3) -> None:
+    """Test sum writes a metrics report."""
+    out = d1.dirpath() / "out_metrics.d4"
+    report = d1.dirpath() / "metrics.json"
+    result = runner.invoke(
+        sum,
+        [str(d1), str(d2), str(d3), str(out), "--chunk-size", "300"]
+        + ["--metrics-out", str(report), "--metrics-interval", "0"],
+    )
+    assert result.exit_code == 0
+    metrics = json.loads(report.read_text("utf-8"))
+    assert metrics["status"] == "done"
+    assert metrics["chunks"] == 4
+    assert metrics["workers"]["counters"]["bytes_decoded"] == 3 * 4 * 1000
+    assert len(metrics["snapshots"]) == 4
+    assert "write" in metrics["parent"]["timers"]
+
+
+def test_sum_empty_chunks(runner, d2, d3, d4) -> None:
+    """Test sum skips writing chunks that are zero throughout."""
+    out = d2.dirpath() / "out_empty.d4"
+    report = d2.dirpath() / "metrics_empty.json"
+    result = runner.invoke(
+        sum,
+        [str(d2), str(d3), str(d4), str(out), "--chunk-size", "100"]
+        + ["--metrics-out", str(report)],
+    )
+    assert result.exit_code == 0
+    x = pyd4.D4File(str(out)).load_to_np("chr1")
+    assert np.all(x[0:500] == 0)
+    assert np.all(x[500:1000] == 3)
+    metrics = json.loads(report.read_text("utf-8"))
+    assert metrics["parent"]["counters"]["empty_tracks"] == 5
+
+
+@pytest.mark.parametrize("executor", ["serial", "process"])
+def test_stream(runner, d1, d2, d3, d4, executor) -> None:
+    """Test streaming reduced chunks from a container."""
+    paths = [str(d1), str(d2), str(d3), str(d4)]
+    d4c = D4Container(paths, outfile=None, chunk_size=300)
+    chunks = list(d4c.stream(cores=2, executor=executor))
+    assert [(chrom, begin) for chrom, begin, _ in chunks] == [
+        ("chr1", 0),
+        ("chr1", 300),
+        ("chr1", 600),
+        ("chr1", 900),
+    ]
+    # Values stay valid after the stream is exhausted
+    out = d1.dirpath() / f"stream_sum_{executor}.d4"
+    result = runner.invoke(sum, paths + [str(out)])
+    assert result.exit_code == 0
+    expected = pyd4.D4File(str(out)).load_to_np("chr1")
+    assert np.array_equal(np.concatenate([x for _, _, x in chunks]), expected)
+    d4c.min_coverage = 1
+    for _, begin, x in d4c.stream("count", executor=executor):
+        pass
+    assert begin == 900
+    assert np.all(x == 3)
+    chunks = list(d4c.stream("count", executor=executor))
+    out = d1.dirpath() / f"stream_count_{executor}.d4"
+    result = runner.invoke(count, paths + [str(out), "--min-coverage", "1"])
+    assert result.exit_code == 0
+    expected = pyd4.D4File(str(out)).load_to_np("chr1")
+    assert np.array_equal(np.concatenate([x for _, _, x in chunks]), expected)
+    d4c.chunk_size = None
+    assert len(list(d4c.stream(executor=executor))) == 1
+    assert d4c.chunk_size is None
+
+
+@pytest.mark.parametrize("executor", ["serial", "thread"])
+def test_stream_interleaved(d1, d3, d4, executor) -> None:
+    """Test two streams of one process consumed in turn."""
+    first = D4Container([str(d3)], outfile=None, chunk_size=100)
+    second = D4Container([str(d3), str(d4)], outfile=None, chunk_size=300)
+    kwargs = {"cores": 2, "window_size": 1, "executor": executor}
+    streams = [first.stream(**kwargs), second.stream(**kwargs)]
+    values = [[], []]
+    for i in [0, 1] * 4 + [0] * 6:
+        _, _, x = next(streams[i])
+        values[i].append(x.copy())
+    x, y = (np.concatenate(v) for v in values)
+    assert np.all(x[:500] == 0) and np.all(x[500:] == 1)
+    assert np.all(y[:500] == 0) and np.all(y[500:] == 3)
+
+
+def test_sum_bedgraph(runner, d1, d2, d3) -> None:
+    """Test sum to a bedGraph file."""
+    out = d1.dirpath() / "out.bedgraph"
+    result = runner.invoke(
+        sum, [str(d1), str(d2), str(d3), str(out), "--chunk-size", "300"]
+    )
+    assert result.exit_code == 0
+    assert out.read_text("utf-8") == "chr1\t0\t500\t1\nchr1\t500\t1000\t2\n"
+
+
+@pytest.mark.parametrize("executor", ["serial", "process"])
+def test_count_npy(runner, d1, d2, d3, d4, executor) -> None:
+    """Test count to a directory of npy arrays."""
+    out = d1.dirpath() / f"count_{executor}.npyd"
+    result = runner.invoke(
+        count,
+        [str(d1), str(d2), str(d3), str(d4), str(out), "--min-coverage", "1"]
+        + ["--chunk-size", "300", "-j", "2", "--executor", executor],
+    )
+    assert result.exit_code == 0
+    x = np.load(str(out / "chr1.npy"))
+    assert np.all(x[0:500] == 1)
+    assert np.all(x[500:1000] == 3)
+
+
 def test_sum_fail(runner, d1, d2, d3) -> None:
     """Test sum fail."""
     result = runner.invoke(sum, [str(d1), str(d2), str(d1)])
     assert result.exit_code != 0
 
 
+def test_stats(runner, d1, d2, d3) -> None:
+    """Test statistics computed in a single pass."""
+    out = d1.dirpath() / "out_stats.d4"
+    result = runner.invoke(
+        stats,
+        [str(d1), str(d2), str(d3), str(out), "--bin", "1:1", "--bin", "2:"]
+        + ["--scale", "9", "--chunk-size", "300", "-j", "2"],
+    )
+    assert result.exit_code == 0
+    expected = {
+        "sum": (1, 2),
+        "mean": (3, 6),
+        "min": (0, 0),
+        "max": (1, 1),
+        "var": (2, 2),
+        "count_1_1": (1, 2),
+        "count_2_inf": (0, 0),
+    }
+    for name, (first, second) in expected.items():
+        x = pyd4.D4File(str(out).replace(".d4", f".{name}.d4"))
+        x = x.load_to_np("chr1")
+        assert np.all(x[0:500] == first), name
+        assert np.all(x[500:1000] == second), name
+    out = d1.dirpath() / "out_stats.bedgraph"
+    result = runner.invoke(stats, [str(d1), str(out), "--multi-track"])
+    assert result.exit_code != 0
+    assert not out.exists()
+
+
 testdata = [
     (
         ["--min-coverage", "1"],
@@ -120,6 +439,61 @@ testdata = [
         ["--max-coverage", "1", "-j", "2"],
         np.concat([4 * np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
     ),
+    (
+        ["--min-coverage", "1", "--chunk-size", "auto"],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        [
+            "--min-coverage",
+            "1",
+            "--chunk-size",
+            "auto",
+            "--memory-budget",
+            "4K",
+        ],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--min-coverage", "1", "--engine", "runs"],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--max-coverage", "1", "--engine", "runs"],
+        np.concat([4 * np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--max-coverage", "1", "--chunk-size", "300", "--window-size", "1"],
+        np.concat([4 * np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--min-coverage", "1", "--prefetch", "0"],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--max-coverage", "1", "--prefetch", "3"],
+        np.concat([4 * np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--min-coverage", "1", "--chunk-size", "70", "--write-batch", "250"],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--min-coverage", "1", "--write-batch", "0"],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--min-coverage", "1", "-j", "2", "--executor", "process"],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--max-coverage", "1", "-j", "2", "--executor", "thread"],
+        np.concat([4 * np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
+    (
+        ["--min-coverage", "1", "--chunk-size", "300", "--executor", "serial"],
+        np.concat([np.ones(500, dtype=int), 3 * np.ones(500, dtype=int)]),
+    ),
 ]
 
 
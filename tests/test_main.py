@@ -8,3 +8,11 @@ def test_main_succeeds(runner: CliRunner) -> None:
     """It exits with a status code of zero."""
     result = runner.invoke(__main__.main)
     assert result.exit_code == 0
+
+
+def test_main_help_lists_lazy_commands(runner: CliRunner) -> None:
+    """It lists the lazily loaded subcommands."""
+    result = runner.invoke(__main__.main, ["--help"])
+    assert result.exit_code == 0
+    assert "count" in result.output
+    assert "sum" in result.output